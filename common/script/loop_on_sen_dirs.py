@@ -1,17 +1,36 @@
 import os
+import time
 from abc import abstractmethod
+from multiprocessing import Pool
 
 from tuw_nlp.sem.hrg.common.script.script import Script
 from tuw_nlp.sem.hrg.steps.bolinas.common.grammar import Grammar
 from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.vo_rule import VoRule
 
 
+def load_grammar(grammar_file, workers=1):
+    return Grammar.load_from_path(grammar_file, VoRule, reverse=False, nodelabels=True, logprob=True,
+                                  workers=workers)
+
+
+def _timed_call(task):
+    func, sen_idx, args = task
+    start = time.time()
+    result = func(*args)
+    return sen_idx, start, time.time(), result
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
 class LoopOnSenDirs(Script):
     def __init__(self, description, log=True, config=None):
         super().__init__(description, log, config)
         self.in_dir = f"{self.data_dir}/{self.config['in_dir']}"
+        self.workers = self.config.get("workers", 1)
 
-    def __get_range(self):
+    def _get_range(self):
         first = self.first
         last = self.last
         sen_dirs = sorted([int(fn.split(".")[0]) for fn in os.listdir(f"{self.in_dir}")])
@@ -22,7 +41,10 @@ class LoopOnSenDirs(Script):
         return [n for n in sen_dirs if first <= n <= last]
 
     def _run_loop(self):
-        for sen_idx in self.__get_range():
+        self._run_sen_loop(self._get_range())
+
+    def _run_sen_loop(self, sen_range):
+        for sen_idx in sen_range:
             if self.first_sen_to_proc is None:
                 self.first_sen_to_proc = sen_idx
             print(f"\nProcessing folder {sen_idx}")
@@ -34,11 +56,59 @@ class LoopOnSenDirs(Script):
     def _do_for_sen(self, sen_idx, sen_dir):
         raise NotImplemented
 
-    def _load_grammar(self):
-        grammar_file = f"{self._get_subdir('grammar', create=False)}/{self.config['grammar_file']}"
+    def _get_sen_cost(self, sen_idx, sen_dir):
+        """
+        Estimated cost of processing a sentence, by default the size of its graph.
+        """
+        graph_file = f"{sen_dir}/pos_edge.graph"
+        return os.path.getsize(graph_file) if os.path.exists(graph_file) else 0
+
+    def _run_in_pool(self, func, sen_args, initializer=None, initargs=()):
+        """
+        Call func(*args) for every (sen_idx, args) in sen_args in a pool of
+        self.workers processes, and yield (sen_idx, result) as they finish.
+        Sentences are queued heaviest first by _get_sen_cost, and idle workers
+        take the next one from the shared queue, so the long sentences do not
+        all end up at the tail of the run. The timing of the sentences is logged.
+        """
+        costs = dict((sen_idx, self._get_sen_cost(sen_idx, f"{self.in_dir}/{str(sen_idx)}"))
+                     for sen_idx, _ in sen_args)
+        tasks = [(func, sen_idx, args) for sen_idx, args in sorted(sen_args, key=lambda x: -costs[x[0]])]
+        self._log(f"Processing {len(tasks)} sentences with {self.workers} workers, longest first")
+
+        timings = []
+        start_time = time.time()
+        with Pool(self.workers, initializer=initializer, initargs=initargs) as pool:
+            for sen_idx, start, end, result in pool.imap_unordered(_timed_call, tasks):
+                timings.append((end - start, sen_idx, start, end))
+                yield sen_idx, result
+        self._log_timings(timings, time.time() - start_time)
 
-        with open(grammar_file) as f:
-            self.grammar = Grammar.load_from_file(f, VoRule, reverse=False, nodelabels=True, logprob=True)
+    def _log_timings(self, timings, elapsed_time):
+        if not timings:
+            return
+        durations = sorted(t[0] for t in timings)
+        slowest = sorted(timings, reverse=True)[:5]
+        # the tail is the time after the last sentence was started, when workers run idle
+        tail = max(t[3] for t in timings) - max(t[2] for t in timings)
+        busy = sum(durations) / (self.workers * elapsed_time) if elapsed_time > 0 else 1.0
+        self._log(
+            f"\nSentence time: "
+            f"median {round(_percentile(durations, 0.5), 2)} sec, "
+            f"p90 {round(_percentile(durations, 0.9), 2)} sec, "
+            f"p99 {round(_percentile(durations, 0.99), 2)} sec, "
+            f"max {round(durations[-1], 2)} sec\n"
+            f"Slowest sentences: {', '.join(f'{t[1]} ({round(t[0], 2)} sec)' for t in slowest)}\n"
+            f"Tail: {round(tail, 2)} sec after the last sentence started\n"
+            f"Worker utilization: {round(100 * busy)}%",
+            print_to_std=True,
+        )
+
+    def _get_grammar_file(self):
+        return f"{self._get_subdir('grammar', create=False)}/{self.config['grammar_file']}"
+
+    def _load_grammar(self):
+        self.grammar = load_grammar(self._get_grammar_file(), self.workers)
 
         rhs2_type = f"-to-{self.grammar.rhs2_type}" if self.grammar.rhs2_type else ''
         self._log(f"\nLoaded {self.grammar.rhs1_type}{rhs2_type} grammar with {len(self.grammar)} rules.")
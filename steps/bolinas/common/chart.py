@@ -8,64 +8,30 @@ class Chart(dict):
     A CKY style parse chart that can return k-best derivations and can return inside and outside probabilities.
     """
 
-    def derivations(self, item="START", only_first=False, max_steps=None, k_best=None):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the budget of the parser that stopped the parse early, if any
+        self.truncated = None
+
+    def derivations(self, item="START", only_first=False, max_steps=None, k_best=None, cache=None):
         start_time = time.time()
         if only_first:
             derivation, steps = self._first_derivation(item)
             derivations = [derivation]
+            elapsed_time = round(time.time() - start_time, 2)
+            search_summary = f"Search: {elapsed_time} sec, {steps} steps"
         else:
-            derivations, steps = self._derivations(item, 0, max_steps, k_best)
-        elapsed_time = round(time.time() - start_time, 2)
-        search_summary = f"Search: {elapsed_time} sec, {steps} steps"
+            search = LazyKBest(self, max_steps, cache)
+            derivations = search.k_best(item, k_best)
+            search_summary = search.summary()
         print(search_summary)
         return derivations, f"{search_summary}\n"
 
-    def _derivations(self, item, done_steps, max_steps, k_best):
+    def iter_derivations(self, item="START", max_steps=None, cache=None):
         """
-        Return all derivations from this chart.
+        Yield the derivations of item best first, computing each one only when it is requested.
         """
-
-        if item == "START":
-            rprob = 0.0
-        else:
-            rprob = item.rule.weight
-
-        # If item is a leaf, just return it and its probability
-        if not item in self:
-            if item == "START":
-                print("No derivations.")
-                return [], 1
-            else:
-                return [(rprob, item)], 1
-
-        pool = []
-        all_steps = done_steps
-        splits = self[item]
-        for split in splits:
-            if max_steps is None or all_steps < max_steps:
-                nts, children = zip(*split.items())
-                children_derivations = [self._derivations(child, all_steps, max_steps, k_best) for child in children]
-                kbest_each_child, steps_each_child = zip(*children_derivations)
-                all_steps += sum(steps_each_child)
-
-                all_combinations = list(itertools.product(*kbest_each_child))
-
-                combinations_for_sorting = []
-                for combination in all_combinations:
-                    weights, trees = zip(*combination)
-                    try:
-                        heapq.heappush(combinations_for_sorting, (sum(weights) + rprob, trees))
-                    except TypeError:
-                        pass
-
-                    for prob, trees in sorted(combinations_for_sorting, key=lambda x: x[0], reverse=True)[:k_best]:
-                        new_tree = (item, dict(zip(nts, trees)))
-                        try:
-                            heapq.heappush(pool, (prob, new_tree))
-                        except TypeError:
-                            pass
-
-        return sorted(pool, key=lambda x: x[0], reverse=True)[:k_best], all_steps - done_steps + 1
+        return LazyKBest(self, max_steps, cache).iter_derivations(item)
 
     def _first_derivation(self, item):
         """
@@ -105,3 +71,162 @@ class Chart(dict):
         return f"Chart START items len: {len(self['START']) if 'START' in self else 0}\n" \
                f"Chart keys len: {len(self)}\n" \
                f"Chart items len: {self.items_length()}\n"
+
+
+class DerivationCache:
+    """
+    Memo table of the derivations found for each chart item.
+
+    The derivation list of an item is a prefix of its k-best list for every k, so
+    a cache can be reused between searches on charts that share their items, e.g.
+    the size-filtered copies of one chart. Only 'START' differs between those,
+    so it is never kept between searches.
+    """
+
+    def __init__(self):
+        self.derived = {}
+        self.splits = {}
+        self.candidates = {}
+        self.seen = {}
+        self.pending = {}
+
+    def forget(self, item):
+        for table in (self.derived, self.splits, self.candidates, self.seen, self.pending):
+            table.pop(item, None)
+
+
+class LazyKBest:
+    """
+    Lazy k-best derivation search over a Chart (Huang and Chiang, 2005, Algorithm 3).
+
+    Every item keeps the derivations found so far, best first, and a frontier of
+    candidates (split index, rank of the derivation taken from each child). The
+    n-th derivation of an item is only computed when somebody asks for it, so
+    asking for the top k derivations expands at most k candidates per item.
+    Candidates are pending until the derivations of their children are found. If
+    max_steps runs out first, they stay pending for the next search on the cache.
+    Derivations with equal scores are ordered by split, then by child ranks.
+    Pass a DerivationCache to reuse the derivations of shared items between searches.
+    """
+
+    def __init__(self, chart, max_steps=None, cache=None):
+        self.chart = chart
+        self.max_steps = max_steps
+        self.steps = 0
+        self.cache = cache if cache is not None else DerivationCache()
+        self.cache.forget("START")
+        self.derived = self.cache.derived
+        self.splits = self.cache.splits
+        self.candidates = self.cache.candidates
+        self.seen = self.cache.seen
+        self.pending = self.cache.pending
+        self.hits = 0
+        self.misses = 0
+        self.start_time = time.time()
+
+    def summary(self):
+        elapsed_time = round(time.time() - self.start_time, 2)
+        return f"Search: {elapsed_time} sec, {self.steps} steps, {self.hits} cache hits, {self.misses} cache misses"
+
+    def k_best(self, item="START", k=None):
+        """
+        Return the k best derivations of item as (score, tree) pairs, best first.
+        If k is None, all derivations are returned.
+        """
+        return list(itertools.islice(self.iter_derivations(item), k))
+
+    def iter_derivations(self, item="START"):
+        """
+        Yield the derivations of item as (score, tree) pairs, best first.
+        """
+        for rank in itertools.count():
+            derivation = self.kth(item, rank)
+            if derivation is None:
+                return
+            yield derivation
+
+    def kth(self, item, rank):
+        """
+        Return the derivation of item at the given (0-based) rank, or None if there is no such derivation.
+        """
+        if item not in self.derived:
+            self._init_item(item)
+        derived = self.derived[item]
+        if len(derived) > rank:
+            self.hits += 1
+        else:
+            self.misses += 1
+        while len(derived) <= rank:
+            if not self._next(item):
+                return None
+        return derived[rank]
+
+    def _rprob(self, item):
+        return 0.0 if item == "START" else item.rule.weight
+
+    def _out_of_steps(self):
+        return self.max_steps is not None and self.steps >= self.max_steps
+
+    def _init_item(self, item):
+        self.candidates[item] = []
+        self.seen[item] = set()
+        self.pending[item] = []
+        if item not in self.chart:
+            # A leaf is its own single derivation
+            if item == "START":
+                print("No derivations.")
+                self.derived[item] = []
+            else:
+                self.derived[item] = [(self._rprob(item), item)]
+            self.splits[item] = []
+            return
+
+        self.derived[item] = []
+        self.splits[item] = [tuple(zip(*split.items())) for split in self.chart[item]]
+        for split_idx in range(len(self.splits[item])):
+            self.pending[item].append((split_idx, (0,) * len(self.splits[item][split_idx][1])))
+
+    def _push(self, item, split_idx, ranks):
+        """
+        Push a candidate of item to its frontier, unless a child has no derivation
+        of the given rank. Returns False if max_steps ran out before that was known.
+        """
+        if (split_idx, ranks) in self.seen[item]:
+            return True
+        nts, children = self.splits[item][split_idx]
+        weights = []
+        for child, rank in zip(children, ranks):
+            derivation = self.kth(child, rank)
+            if derivation is None:
+                if self._out_of_steps():
+                    return False
+                break
+            weights.append(derivation[0])
+        else:
+            prob = sum(weights) + self._rprob(item)
+            heapq.heappush(self.candidates[item], (-prob, split_idx, ranks))
+        self.seen[item].add((split_idx, ranks))
+        return True
+
+    def _next(self, item):
+        """
+        Move the best candidate of item to its derivation list. Return False if there is none left.
+        """
+        if self._out_of_steps():
+            return False
+        pending = self.pending[item]
+        while pending:
+            if not self._push(item, *pending[-1]):
+                return False
+            pending.pop()
+        candidates = self.candidates[item]
+        if not candidates:
+            return False
+        self.steps += 1
+        neg_prob, split_idx, ranks = heapq.heappop(candidates)
+        nts, children = self.splits[item][split_idx]
+        trees = [self.kth(child, rank)[1] for child, rank in zip(children, ranks)]
+        self.derived[item].append((-neg_prob, (item, dict(zip(nts, trees)))))
+        # Successors of this derivation are only pushed when the next one is needed
+        pending.extend((split_idx, ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]) for i in range(len(ranks)))
+        return True
@@ -0,0 +1,297 @@
+import json
+import lzma
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from tuw_nlp.sem.hrg.steps.bolinas.common.chart import Chart
+from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import ChartFileError
+from tuw_nlp.sem.hrg.steps.bolinas.common.symbols import SymbolTable
+from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.vo_item import GraphIndex, HergItem
+
+# A chart file is the magic bytes, the length of the JSON header as a
+# little-endian uint32, the header, and the arrays listed in the header's
+# "sections", one after the other and compressed together by the codec.
+CHART_FILE_MAGIC = b"HRGCHART"
+CHART_FILE_VERSION = 1
+CHART_FILE_CODECS = {
+    None: None,
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def write_chart(chart_file, chart, grammar, codec=None):
+    """
+    Write a parse chart to chart_file. Items are stored by rule id, size, mapping and
+    bitsets over the graph index of the parse, and the splits of the chart as
+    indices into the items, so the rules are read from the grammar file on load.
+    The grammar file is recorded relative to the directory of chart_file.
+    """
+    if codec not in CHART_FILE_CODECS:
+        raise ChartFileError("Unknown chart file codec %s." % codec)
+    if grammar.source_file is None:
+        raise ChartFileError("Charts can only be written for grammars loaded with Grammar.load_from_path.")
+
+    strings = SymbolTable()
+    item_ids = {}
+
+    def item_id(item):
+        if item not in item_ids:
+            item_ids[item] = len(item_ids)
+        return item_ids[item]
+
+    nt_ids = {}
+    nt_symbols = array("i")
+    nt_indices = array("i")
+
+    def nt_id(nt):
+        if nt not in nt_ids:
+            nt_ids[nt] = len(nt_ids)
+            symbol, index = nt
+            nt_symbols.append(strings.id(symbol))
+            nt_indices.append(strings.id(index) if index is not None else -1)
+        return nt_ids[nt]
+
+    start_items = array("i", (item_id(split["START"]) for split in chart.get("START", ())))
+    keys = array("i")
+    split_offsets = array("i", [0])
+    child_offsets = array("i", [0])
+    child_nts = array("i")
+    child_items = array("i")
+    for item, splits in chart.items():
+        if item == "START":
+            continue
+        keys.append(item_id(item))
+        for split in splits:
+            for nt, child in split.items():
+                child_nts.append(nt_id(nt))
+                child_items.append(item_id(child))
+            child_offsets.append(len(child_items))
+        split_offsets.append(len(child_offsets) - 1)
+
+    items = list(item_ids)
+    graph_index = items[0].graph_index if items else GraphIndex(())
+    nodelabels = grammar.nodelabels
+
+    # the edges of the graph index, from which the same node numbers and bits are
+    # assigned on load
+    node_ids = graph_index.node_numbers
+    node_names = array("i", (strings.id(node) for node in graph_index.nodes))
+    node_labels = array("i", [-1] * len(graph_index.nodes))
+    edge_heads = array("i")
+    edge_labels = array("i")
+    tail_offsets = array("i", [0])
+    tails = array("i")
+    for head, rel, tail_nodes in graph_index.edges:
+        if not isinstance(rel, str):
+            raise ChartFileError("Cannot write the edge label %s of the input graph." % repr(rel))
+        if nodelabels:
+            for node, label in (head,) + tuple(tail_nodes):
+                node_labels[node_ids[node]] = strings.id(label)
+            head = head[0]
+            tail_nodes = [node for node, label in tail_nodes]
+        edge_heads.append(node_ids[head])
+        edge_labels.append(strings.id(rel))
+        tails.extend(node_ids[node] for node in tail_nodes)
+        tail_offsets.append(len(tails))
+
+    edge_bytes = (len(graph_index.edges) + 7) // 8
+    node_bytes = (len(graph_index.nodes) + 7) // 8
+    item_rules = array("i")
+    item_sizes = array("i")
+    mapping_offsets = array("i", [0])
+    mappings = array("i")
+    shifted = bytearray()
+    nodesets = bytearray()
+    for item in items:
+        item_rules.append(item.rule.rule_id)
+        item_sizes.append(item.size)
+        mappings.extend(node if node is not None else -1 for node in item.mapping)
+        mapping_offsets.append(len(mappings))
+        shifted += item.shifted.to_bytes(edge_bytes, "little")
+        nodesets += item.nodeset.to_bytes(node_bytes, "little")
+
+    sections = [
+        ("node_names", node_names), ("node_labels", node_labels),
+        ("edge_heads", edge_heads), ("edge_labels", edge_labels),
+        ("tail_offsets", tail_offsets), ("tails", tails),
+        ("nt_symbols", nt_symbols), ("nt_indices", nt_indices),
+        ("item_rules", item_rules), ("item_sizes", item_sizes),
+        ("mapping_offsets", mapping_offsets), ("mappings", mappings),
+        ("start_items", start_items), ("keys", keys), ("split_offsets", split_offsets),
+        ("child_offsets", child_offsets), ("child_nts", child_nts), ("child_items", child_items),
+        ("shifted", array("B", shifted)), ("nodesets", array("B", nodesets)),
+    ]
+    header = json.dumps({
+        "version": CHART_FILE_VERSION,
+        "codec": codec,
+        "byteorder": sys.byteorder,
+        "grammar_file": os.path.relpath(grammar.source_file, os.path.dirname(os.path.abspath(chart_file))),
+        "grammar_fingerprint": grammar.fingerprint,
+        "nodelabels": nodelabels,
+        "truncated": chart.truncated,
+        "edge_bytes": edge_bytes,
+        "node_bytes": node_bytes,
+        "strings": strings.symbols,
+        "sections": [(name, values.typecode, len(values)) for name, values in sections],
+    }).encode("utf-8")
+    payload = b"".join(values.tobytes() for name, values in sections)
+    if codec is not None:
+        payload = CHART_FILE_CODECS[codec][0](payload)
+    with open(chart_file, "wb") as f:
+        f.write(CHART_FILE_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(payload)
+
+
+class ChartFile(object):
+    """
+    A chart file read into memory. The sections are memoryviews of the file content,
+    or of its decompressed payload, and are only copied if the byte order differs.
+    """
+
+    def __init__(self, chart_file):
+        self.path = chart_file
+        with open(chart_file, "rb") as f:
+            data = f.read()
+        if data[:len(CHART_FILE_MAGIC)] != CHART_FILE_MAGIC:
+            raise ChartFileError("%s is not a chart file." % chart_file)
+        try:
+            offset = len(CHART_FILE_MAGIC)
+            header_length, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            self.header = json.loads(data[offset:offset + header_length])
+            if self.header["version"] != CHART_FILE_VERSION:
+                raise ChartFileError("%s has chart file version %s, expected %s."
+                                     % (chart_file, self.header["version"], CHART_FILE_VERSION))
+
+            payload = memoryview(data)[offset + header_length:]
+            if self.header["codec"] is not None:
+                payload = memoryview(CHART_FILE_CODECS[self.header["codec"]][1](payload))
+            sizes = [length * array(typecode).itemsize for name, typecode, length in self.header["sections"]]
+        except (struct.error, ValueError, KeyError, zlib.error, lzma.LZMAError) as e:
+            raise ChartFileError("%s is damaged: %s" % (chart_file, e))
+        if sum(sizes) != len(payload):
+            raise ChartFileError("%s is damaged: expected %d bytes of sections, found %d."
+                                 % (chart_file, sum(sizes), len(payload)))
+        self.sections = {}
+        offset = 0
+        for (name, typecode, length), nbytes in zip(self.header["sections"], sizes):
+            view = payload[offset:offset + nbytes].cast(typecode)
+            if self.header["byteorder"] != sys.byteorder and typecode != "B":
+                values = array(typecode, view)
+                values.byteswap()
+                view = memoryview(values)
+            self.sections[name] = view
+            offset += nbytes
+
+    @property
+    def grammar_file(self):
+        """
+        The grammar file the chart was parsed with, resolved from the directory of
+        the chart file.
+        """
+        return os.path.normpath(os.path.join(os.path.dirname(self.path), self.header["grammar_file"]))
+
+    def to_chart(self, grammar):
+        """
+        Returns the chart as a LazyChart over the rules of grammar, which must be
+        the grammar the chart was parsed with.
+        """
+        if grammar.fingerprint != self.header["grammar_fingerprint"]:
+            raise ChartFileError("The grammar %s is not the grammar %s was parsed with."
+                                 % (grammar.source_file, self.path))
+        return LazyChart(self, grammar)
+
+    def graph_index(self):
+        """
+        Rebuilds the graph index of the parse.
+        """
+        strings = self.header["strings"]
+        sections = self.sections
+        node_names = [strings[i] for i in sections["node_names"]]
+        if self.header["nodelabels"]:
+            nodes = [(name, strings[label]) for name, label in zip(node_names, sections["node_labels"])]
+        else:
+            nodes = node_names
+        tail_offsets = sections["tail_offsets"]
+        tails = sections["tails"]
+        edges = []
+        for i, (head, label) in enumerate(zip(sections["edge_heads"], sections["edge_labels"])):
+            tail_nodes = tuple(nodes[j] for j in tails[tail_offsets[i]:tail_offsets[i + 1]])
+            edges.append((nodes[head], strings[label], tail_nodes))
+        return GraphIndex(edges, nodelabels=self.header["nodelabels"])
+
+
+class LazyChart(Chart):
+    """
+    A Chart read from a chart file. An item only becomes a HergItem, and the splits
+    of an item are only built, when a derivation search reaches it. len() and
+    iteration only see the entries built so far.
+    """
+
+    def __init__(self, chart_file, grammar):
+        super().__init__()
+        self.chart_file = chart_file
+        self.grammar = grammar
+        self.graph_index = chart_file.graph_index()
+        self.truncated = chart_file.header["truncated"]
+        self.item_cache = [None] * len(chart_file.sections["item_rules"])
+        self.item_ids = {}
+        self.key_positions = dict((item_id, i) for i, item_id in enumerate(chart_file.sections["keys"]))
+        start_items = chart_file.sections["start_items"]
+        if len(start_items):
+            self["START"] = [{"START": self.item(item_id)} for item_id in start_items]
+
+    def item(self, item_id):
+        """
+        Returns the HergItem with the given index in the chart file.
+        """
+        item = self.item_cache[item_id]
+        if item is None:
+            sections = self.chart_file.sections
+            header = self.chart_file.header
+            mapping = tuple(j if j >= 0 else None for j in
+                            sections["mappings"][sections["mapping_offsets"][item_id]:
+                                                 sections["mapping_offsets"][item_id + 1]])
+            edge_bytes = header["edge_bytes"]
+            node_bytes = header["node_bytes"]
+            shifted = int.from_bytes(sections["shifted"][item_id * edge_bytes:(item_id + 1) * edge_bytes], "little")
+            nodeset = int.from_bytes(sections["nodesets"][item_id * node_bytes:(item_id + 1) * node_bytes], "little")
+            item = HergItem(self.grammar[sections["item_rules"][item_id]], sections["item_sizes"][item_id],
+                            shifted, mapping, nodeset, self.graph_index)
+            self.item_cache[item_id] = item
+            self.item_ids[item] = item_id
+        return item
+
+    def _key_position(self, item):
+        item_id = self.item_ids.get(item)
+        return self.key_positions.get(item_id) if item_id is not None else None
+
+    def __contains__(self, item):
+        return dict.__contains__(self, item) or self._key_position(item) is not None
+
+    def __missing__(self, item):
+        position = self._key_position(item)
+        if position is None:
+            raise KeyError(item)
+        sections = self.chart_file.sections
+        strings = self.chart_file.header["strings"]
+        nt_symbols = sections["nt_symbols"]
+        nt_indices = sections["nt_indices"]
+        child_offsets = sections["child_offsets"]
+        splits = []
+        for split in range(sections["split_offsets"][position], sections["split_offsets"][position + 1]):
+            children = {}
+            for i in range(child_offsets[split], child_offsets[split + 1]):
+                nt = sections["child_nts"][i]
+                symbol = strings[nt_symbols[nt]]
+                index = strings[nt_indices[nt]] if nt_indices[nt] >= 0 else None
+                children[symbol, index] = self.item(sections["child_items"][i])
+            splits.append(children)
+        self[item] = splits
+        return splits
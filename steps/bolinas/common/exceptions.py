@@ -22,17 +22,21 @@ class GrammarError(Exception):
     pass
 
 
+class ChartFileError(Exception):
+    pass
+
+
 class ParseTooLongException(Exception):
     def __init__(self, steps, queue, attempted):
         self.steps = steps
         self.queue_len = len(queue)
-        self.attempted_len = len(attempted)
+        self.attempted = attempted
 
     def print_message(self):
         return f"Parse did not finish:\n" \
                f"- steps: {self.steps}\n" \
                f"- queue len: {self.queue_len}\n" \
-               f"- attempted len:{self.attempted_len}\n"
+               f"- attempted completions: {self.attempted}\n"
 
 
 class CkyTooLongException(Exception):
@@ -1,9 +1,13 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+import glob
+import hashlib
 import math
+import os
+import pickle
 from io import StringIO
 
 from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import GrammarError, ParserError
-from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.hgraph import Hgraph
+from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.graph_description_parser import load_graphs
 from tuw_nlp.sem.hrg.steps.bolinas.common.nonterminal import NonterminalLabel
 from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.vo_rule import VoRule
 
@@ -11,6 +15,10 @@ GRAPH_FORMAT = "hypergraph"
 STRING_FORMAT = "string"
 TREE_FORMAT = "tree"
 
+# Increase when the pickled layout of Grammar, the rules or their graphs changes,
+# so that compiled grammars written by older code are rebuilt.
+COMPILED_GRAMMAR_VERSION = 4
+
 
 def parse_string(s):
     """
@@ -58,10 +66,18 @@ class Grammar(dict):
         self.nonterminal_to_rules = defaultdict(set)
         self.rhs1_terminal_to_rules = defaultdict(set)
         self.rhs2_terminal_to_rules = defaultdict(set)
+        self.rhs1_terminal_count = {}
+        self.rhs2_terminal_count = {}
+        self.symbol_to_users = {}
         self.startsymbol = None
 
+        # the grammar file and content hash, set by load_from_path
+        self.source_file = None
+        self.fingerprint = None
+
     @classmethod
-    def load_from_file(cls, in_file, rule_class=VoRule, reverse=False, nodelabels=False, logprob=False):
+    def load_from_file(cls, in_file, rule_class=VoRule, reverse=False, nodelabels=False, logprob=False,
+                       workers=1):
         """
         Loads a SHRG grammar from the given file.
         See documentation for format details.
@@ -69,6 +85,9 @@ class Grammar(dict):
         rule_class specifies the type of rule to use. VoRule is a subclass using an arbitrary graph
         visit order (also used for strings). TdRule computes a tree decomposition on the first RHS
         when initialized.
+
+        The rules are read first, and their right hand sides are then parsed in bulk,
+        in a pool of worker processes if workers > 1.
         """
 
         output = Grammar(nodelabels=nodelabels, logprob=logprob)
@@ -81,6 +100,7 @@ class Grammar(dict):
         rhs2_type = None
 
         buf = StringIO()
+        rule_strings = []
 
         for line in in_file:
             line_count += 1
@@ -103,76 +123,92 @@ class Grammar(dict):
                         lhs, rhsstring = content.split("->")
                     except:
                         raise GrammarError("Line %i, Rule %i: Invalid rule format." % (line_count, rule_count))
-                    lhs = lhs.strip()
-                    if rule_count == 1:
-                        output.start_symbol = lhs
                     if "|" in rhsstring:
-                        if not is_synchronous and rule_count > 1:
-                            raise GrammarError("Line %i, Rule %i: All or none of the rules need to have two RHSs."
-                                               % (line_count, rule_count))
-                        is_synchronous = True
                         try:
                             rhs1, rhs2 = rhsstring.split("|")
                         except:
                             raise GrammarError("Only up to two RHSs are allowed in grammar file.")
                     else:
-                        if is_synchronous and rule_count > 0:
-                            raise ParserError("Line %i, Rule %i: All or none of the rules need to have two RHSs."
-                                              % (line_count, rule_count))
-                        is_synchronous = False
                         rhs1 = rhsstring
                         rhs2 = None
-
-                    try:  # If the first graph in the file cannot be parsed, assume it's a string
-                        r1 = Hgraph.from_string(rhs1)
-                        r1_nts = set([(ntlabel.label, ntlabel.index) for h, ntlabel, t in r1.nonterminal_edges()])
-                        if not rhs1_type:
-                            rhs1_type = GRAPH_FORMAT
-                    except (ParserError, IndexError) as e:
-                        if rhs1_type == GRAPH_FORMAT:
-                            raise ParserError("Line %i, Rule %i: Could not parse graph description: %s"
-                                              % (line_count, rule_count, e.message))
-                        else:
-                            r1 = parse_string(rhs1)
-                            nts = [t for t in r1 if isinstance(t, NonterminalLabel)]
-                            r1_nts = set([(ntlabel.label, ntlabel.index) for ntlabel in nts])
-                            rhs1_type = STRING_FORMAT
-
-                    if is_synchronous:
-                        try:  # If the first graph in the file cannot be parsed, assume it's a string
-                            if rhs2_type:
-                                assert rhs2_type == GRAPH_FORMAT
-                            r2 = Hgraph.from_string(rhs2)
-                            r2_nts = set([(ntlabel.label, ntlabel.index) for h, ntlabel, t in r2.nonterminal_edges()])
-                            if not rhs2_type:
-                                rhs2_type = GRAPH_FORMAT
-                        except (ParserError, IndexError, AssertionError) as e:
-                            if rhs2_type == GRAPH_FORMAT:
-                                raise ParserError("Line %i, Rule %i: Could not parse graph description: %s"
-                                                  % (line_count, rule_count, e))
-                            else:
-                                r2 = parse_string(rhs2)
-                                nts = [t for t in r2 if isinstance(t, NonterminalLabel)]
-                                r2_nts = set([(ntlabel.label, ntlabel.index) for ntlabel in nts])
-                                rhs2_type = STRING_FORMAT
-                        if not r1_nts == r2_nts:
-                            raise GrammarError("Line %i, Rule %i: Nonterminals do not match between RHSs: %s %s"
-                                               % (line_count, rule_count, str(r1_nts), str(r2_nts)))
-                    else:
-                        r2 = None
-                    try:
-                        if is_synchronous and reverse:
-                            output[rule_count] = rule_class(rule_count, lhs, weight, r2, r1, nodelabels=nodelabels,
-                                                            logprob=logprob)
-                        else:
-                            output[rule_count] = rule_class(rule_count, lhs, weight, r1, r2, nodelabels=nodelabels,
-                                                            logprob=logprob)
-                    except Exception as e:
-                        raise GrammarError(
-                            "Line %i, Rule %i: Could not initialize rule. %s" % (line_count, rule_count, e))
+                    rule_strings.append((line_count, rule_count, lhs.strip(), weight, rhs1, rhs2))
                     buf = StringIO()
                     rule_count += 1
 
+        # Hgraphs of the right hand sides in file order. The exception of a side that is not
+        # a graph description is raised when its rule is built.
+        graphs = load_graphs(
+            (rhs for _, _, _, _, rhs1, rhs2 in rule_strings for rhs in (rhs1, rhs2) if rhs is not None),
+            workers=workers,
+            errors=True,
+        )
+
+        for line_count, rule_count, lhs, weight, rhs1, rhs2 in rule_strings:
+            if rule_count == 1:
+                output.start_symbol = lhs
+            if rhs2 is not None:
+                if not is_synchronous and rule_count > 1:
+                    raise GrammarError("Line %i, Rule %i: All or none of the rules need to have two RHSs."
+                                       % (line_count, rule_count))
+                is_synchronous = True
+            else:
+                if is_synchronous and rule_count > 0:
+                    raise ParserError("Line %i, Rule %i: All or none of the rules need to have two RHSs."
+                                      % (line_count, rule_count))
+                is_synchronous = False
+
+            r1 = next(graphs)
+            try:  # If the first graph in the file cannot be parsed, assume it's a string
+                if isinstance(r1, Exception):
+                    raise r1
+                r1_nts = set([(ntlabel.label, ntlabel.index) for h, ntlabel, t in r1.nonterminal_edges()])
+                if not rhs1_type:
+                    rhs1_type = GRAPH_FORMAT
+            except (ParserError, IndexError) as e:
+                if rhs1_type == GRAPH_FORMAT:
+                    raise ParserError("Line %i, Rule %i: Could not parse graph description: %s"
+                                      % (line_count, rule_count, e.message))
+                else:
+                    r1 = parse_string(rhs1)
+                    nts = [t for t in r1 if isinstance(t, NonterminalLabel)]
+                    r1_nts = set([(ntlabel.label, ntlabel.index) for ntlabel in nts])
+                    rhs1_type = STRING_FORMAT
+
+            if is_synchronous:
+                r2 = next(graphs)
+                try:  # If the first graph in the file cannot be parsed, assume it's a string
+                    if rhs2_type:
+                        assert rhs2_type == GRAPH_FORMAT
+                    if isinstance(r2, Exception):
+                        raise r2
+                    r2_nts = set([(ntlabel.label, ntlabel.index) for h, ntlabel, t in r2.nonterminal_edges()])
+                    if not rhs2_type:
+                        rhs2_type = GRAPH_FORMAT
+                except (ParserError, IndexError, AssertionError) as e:
+                    if rhs2_type == GRAPH_FORMAT:
+                        raise ParserError("Line %i, Rule %i: Could not parse graph description: %s"
+                                          % (line_count, rule_count, e))
+                    else:
+                        r2 = parse_string(rhs2)
+                        nts = [t for t in r2 if isinstance(t, NonterminalLabel)]
+                        r2_nts = set([(ntlabel.label, ntlabel.index) for ntlabel in nts])
+                        rhs2_type = STRING_FORMAT
+                if not r1_nts == r2_nts:
+                    raise GrammarError("Line %i, Rule %i: Nonterminals do not match between RHSs: %s %s"
+                                       % (line_count, rule_count, str(r1_nts), str(r2_nts)))
+            else:
+                r2 = None
+            try:
+                if is_synchronous and reverse:
+                    output[rule_count] = rule_class(rule_count, lhs, weight, r2, r1, nodelabels=nodelabels,
+                                                    logprob=logprob)
+                else:
+                    output[rule_count] = rule_class(rule_count, lhs, weight, r1, r2, nodelabels=nodelabels,
+                                                    logprob=logprob)
+            except Exception as e:
+                raise GrammarError(
+                    "Line %i, Rule %i: Could not initialize rule. %s" % (line_count, rule_count, e))
+
         output.is_synchronous = is_synchronous
         if is_synchronous and reverse:
             output.rhs1_type, output.rhs2_type = rhs2_type, rhs1_type
@@ -182,65 +218,190 @@ class Grammar(dict):
         output._compute_reachability_table_lookup()
         return output
 
+    @classmethod
+    def load_from_path(cls, grammar_file, rule_class=VoRule, reverse=False, nodelabels=False, logprob=False,
+                       workers=1):
+        """
+        Loads a grammar file like load_from_file, but keeps a compiled copy of the
+        loaded grammar next to it. The copy is named after a hash of the load options
+        and a hash of the file content, so a changed grammar file is compiled again
+        and the stale copies with the same options are removed, while the copies
+        loaded with other options are kept.
+        """
+        with open(grammar_file, "rb") as f:
+            content = f.read()
+        options_key = hashlib.sha256(
+            repr((rule_class.__name__, reverse, nodelabels, logprob)).encode()).hexdigest()[:8]
+        content_key = hashlib.sha256(content + repr(COMPILED_GRAMMAR_VERSION).encode()).hexdigest()[:16]
+        fingerprint = f"{options_key}.{content_key}"
+        compiled_file = f"{grammar_file}.{fingerprint}.compiled"
+
+        if os.path.exists(compiled_file):
+            try:
+                with open(compiled_file, "rb") as f:
+                    grammar = pickle.load(f)
+                grammar.source_file = os.path.abspath(grammar_file)
+                return grammar
+            except Exception:
+                pass
+
+        grammar = cls.load_from_file(StringIO(content.decode("utf-8")), rule_class, reverse=reverse,
+                                     nodelabels=nodelabels, logprob=logprob, workers=workers)
+        grammar.source_file = os.path.abspath(grammar_file)
+        grammar.fingerprint = fingerprint
+        try:
+            # parallel workers may compile the same grammar, the rename makes sure
+            # every reader sees a complete file
+            tmp_file = f"{compiled_file}.{os.getpid()}"
+            with open(tmp_file, "wb") as f:
+                pickle.dump(grammar, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, compiled_file)
+            # older contents with the same options, and copies named by a single hash
+            # of content and options by earlier versions
+            stale_files = glob.glob(f"{glob.escape(grammar_file)}.{options_key}.*.compiled")
+            stale_files += glob.glob(f"{glob.escape(grammar_file)}.{'?' * 16}.compiled")
+            for stale_file in stale_files:
+                if stale_file != compiled_file:
+                    os.remove(stale_file)
+        except OSError:
+            pass
+        return grammar
+
     def _compute_reachability_table_lookup(self):
         """
-        Fill a table mapping rhs symbols to rules so that we can compute reachability.
+        Fill a table mapping rhs symbols to rules so that we can compute reachability,
+        and index the rules by their terminals so that we can filter them by an input.
         """
         for r in self:
             rule = self[r]
-            if self.rhs1_type is GRAPH_FORMAT:
+            if self.rhs1_type == GRAPH_FORMAT:
                 self.lhs_to_rules[rule.symbol, len(rule.rhs1.external_nodes)].add(r)
                 terminals, nonterminals = rule.rhs1.get_terminals_and_nonterminals(self.nodelabels)
                 for nt in nonterminals:
                     self.nonterminal_to_rules[nt].add(r)
-            elif self.rhs1_type is STRING_FORMAT:
+            elif self.rhs1_type == STRING_FORMAT:
                 terminals, nonterminals = _terminals_and_nts_from_string(rule.rhs1)
                 self.lhs_to_rules[rule.symbol].add(r)
                 for t in nonterminals:
                     self.nonterminal_to_rules[t].add(r)
+            else:
+                terminals = set()
+            self.rhs1_terminal_count[r] = len(terminals)
+            for t in terminals:
+                self.rhs1_terminal_to_rules[t].add(r)
 
-    def terminal_filter(self, input1, input2):
+            if self.is_synchronous:
+                terminals = self._terminals(rule.rhs2, self.rhs2_type)
+                self.rhs2_terminal_count[r] = len(terminals)
+                for t in terminals:
+                    self.rhs2_terminal_to_rules[t].add(r)
 
-        input1_terminals = set()
-        input2_terminals = set()
+    def _terminals(self, rhs, rhs_type):
+        if rhs_type == GRAPH_FORMAT:
+            return rhs.get_terminals_and_nonterminals(self.nodelabels)[0]
+        elif rhs_type == STRING_FORMAT:
+            return _terminals_and_nts_from_string(rhs)[0]
+        return set()
 
-        if self.rhs1_type is GRAPH_FORMAT:
-            input1_terminals, input1_nts = input1.get_terminals_and_nonterminals(self.nodelabels)
-        elif self.rhs1_type is STRING_FORMAT:
-            input1_terminals, input1_nonterminals = _terminals_and_nts_from_string(input1)
+    @staticmethod
+    def _rules_covered_by(input_terminals, terminal_to_rules, terminal_count):
+        """
+        Returns the rules all of whose terminals are in input_terminals.
+        """
+        hits = Counter()
+        for t in input_terminals:
+            if t in terminal_to_rules:
+                hits.update(terminal_to_rules[t])
+        return set(r for r, count in terminal_count.items() if count == hits[r])
 
+    def terminal_filter(self, input1, input2):
+        """
+        Returns the rules whose terminals all occur in the input(s), in grammar order.
+        """
+        accepted = self._rules_covered_by(self._terminals(input1, self.rhs1_type),
+                                          self.rhs1_terminal_to_rules, self.rhs1_terminal_count)
         if input2:
-            if self.rhs2_type is GRAPH_FORMAT:
-                input2_terminals, input2_nts = input2.get_terminals_and_nonterminals(self.nodelabels)
-            elif self.rhs2_type is STRING_FORMAT:
-                input2_terminals, input2_nts = _terminals_and_nts_from_string(input2)
+            accepted &= self._rules_covered_by(self._terminals(input2, self.rhs2_type),
+                                               self.rhs2_terminal_to_rules, self.rhs2_terminal_count)
+        return sorted(accepted)
 
-        accepted = list()
-        for r in self:
-            terminals1, terminals2 = set(), set()
-            if self.rhs1_type is GRAPH_FORMAT:
-                terminals1, nonterminals = self[r].rhs1.get_terminals_and_nonterminals(self.nodelabels)
-            elif self.rhs1_type is STRING_FORMAT:
-                terminals1, nonterminals = _terminals_and_nts_from_string(self[r].rhs1)
-            if input2:
-                if self.rhs2_type is GRAPH_FORMAT:
-                    terminals2, nonterminals = self[r].rhs2.get_terminals_and_nonterminals(self.nodelabels)
-                elif self.rhs2_type is STRING_FORMAT:
-                    terminals2, nonterminals = _terminals_and_nts_from_string(self[r].rhs2)
-
-            if terminals1.issubset(input1_terminals):
-                if input2 is None or terminals2.issubset(input2_terminals):
-                    accepted.append(r)
-            if not terminals1 and not terminals2:
-                accepted.append(r)
-
-        return accepted
+    def _users(self, symbol):
+        """
+        Returns the rules that can use a rule with the given LHS symbol, directly or
+        through other rules. The result is cached for every symbol.
+        """
+        if symbol not in self.symbol_to_users:
+            users = set()
+            symbols = {symbol}
+            todo = [symbol]
+            while todo:
+                for r in self.nonterminal_to_rules.get(todo.pop(), ()):
+                    if r not in users:
+                        users.add(r)
+                        if self[r].symbol not in symbols:
+                            symbols.add(self[r].symbol)
+                            todo.append(self[r].symbol)
+            self.symbol_to_users[symbol] = frozenset(users)
+        return self.symbol_to_users[symbol]
 
     def reachable_rules(self, input1, input2):
-        todo = list(self.terminal_filter(input1, input2))
-        result = set()
-        while todo:
-            r = todo.pop()
-            result.add(r)
-            todo.extend(self.nonterminal_to_rules[self[r].symbol] - result)
+        result = set(self.terminal_filter(input1, input2))
+        for symbol in set(self[r].symbol for r in result):
+            result |= self._users(symbol)
         return result
+
+    def score_estimates(self):
+        """
+        Estimate the best score a derivation can reach from each nonterminal.
+
+        Returns (inside, outside): inside[nt] is the best score of a derivation
+        rooted in nt, outside[nt] the best score of the rest of a derivation of
+        the start symbol around an nt. Both are computed by relaxing the rules
+        until nothing improves. If they still improve after as many rounds as
+        there are nonterminals, or a score overflows to inf, recursive rules can
+        raise the score without limit (e.g. weights that are not log
+        probabilities), and None is returned.
+        """
+        nt_edges = {}
+        for r, rule in self.items():
+            nt_edges[r] = [t[1].label for t in rule.rhs1.nonterminal_edges()]
+        symbols = set(rule.symbol for rule in self.values())
+        for labels in nt_edges.values():
+            symbols.update(labels)
+
+        inside = dict((nt, float("-inf")) for nt in symbols)
+        outside = dict((nt, float("-inf")) for nt in symbols)
+        outside[self.start_symbol] = 0.0
+        for relax, scores in ((self._relax_inside, inside), (self._relax_outside, outside)):
+            # the scores are updated in place, so a single round can already
+            # overflow them, after which nothing improves any more
+            for _ in range(len(symbols) + 1):
+                changed = relax(nt_edges, inside, outside)
+                if any(math.isnan(score) or score == math.inf for score in scores.values()):
+                    return None
+                if not changed:
+                    break
+            else:
+                return None
+        return inside, outside
+
+    def _relax_inside(self, nt_edges, inside, outside):
+        changed = False
+        for r, rule in self.items():
+            score = rule.weight + sum(inside[label] for label in nt_edges[r])
+            if score > inside[rule.symbol]:
+                inside[rule.symbol] = score
+                changed = True
+        return changed
+
+    def _relax_outside(self, nt_edges, inside, outside):
+        changed = False
+        for r, rule in self.items():
+            labels = nt_edges[r]
+            for i, label in enumerate(labels):
+                others = sum(inside[other] for j, other in enumerate(labels) if j != i)
+                score = outside[rule.symbol] + rule.weight + others
+                if score > outside[label]:
+                    outside[label] = score
+                    changed = True
+        return changed
@@ -0,0 +1,107 @@
+from array import array
+
+
+class GraphAdjacency:
+    """
+    A compact, read-only copy of the edges of an Hgraph.
+    Nodes and edge labels are numbered in the order they are first seen. The outgoing
+    edges of node i are edge_offsets[i]:edge_offsets[i + 1], sorted by the string of
+    their label once, when the adjacency is built, and the tail nodes of edge e are
+    tails[tail_offsets[e]:tail_offsets[e + 1]].
+    """
+
+    def __init__(self, graph):
+        self.nodes = list(dict.keys(graph))
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        self.labels = []
+        self.label_ids = {}
+        # the (parent, label, tail) triples of the graph in edge order
+        self.edges = []
+
+        edge_offsets = [0]
+        edge_labels = []
+        tail_offsets = [0]
+        tails = []
+        for node in self.nodes[:len(self.node_ids)]:
+            for rel, child in sorted(dict.__getitem__(graph, node).items(), key=lambda x: str(x[0])):
+                if rel not in self.label_ids:
+                    self.label_ids[rel] = len(self.labels)
+                    self.labels.append(rel)
+                edge_labels.append(self.label_ids[rel])
+                for c in (child if type(child) is tuple else (child,)):
+                    if c not in self.node_ids:
+                        self.node_ids[c] = len(self.nodes)
+                        self.nodes.append(c)
+                    tails.append(self.node_ids[c])
+                tail_offsets.append(len(tails))
+                self.edges.append((node, rel, child))
+            edge_offsets.append(len(self.edges))
+        # nodes that only occur as tails have no outgoing edges
+        edge_offsets.extend([len(self.edges)] * (len(self.nodes) + 1 - len(edge_offsets)))
+
+        self.edge_offsets = array("i", edge_offsets)
+        self.edge_labels = array("i", edge_labels)
+        self.tail_offsets = array("i", tail_offsets)
+        self.tails = array("i", tails)
+
+    def out_degree(self, node):
+        """
+        Return the number of edges leaving a node.
+        """
+        i = self.node_ids.get(node)
+        if i is None:
+            return 0
+        return self.edge_offsets[i + 1] - self.edge_offsets[i]
+
+    def out_edges(self, i):
+        """
+        Return the (parent, label, tail) triples leaving the node with id i.
+        """
+        return self.edges[self.edge_offsets[i]:self.edge_offsets[i + 1]]
+
+    def traverse(self, start_nodes):
+        """
+        Return the ids of the nodes reachable from start_nodes in breadth-first order,
+        and the depth of each.
+        """
+        edge_offsets = self.edge_offsets
+        tail_offsets = self.tail_offsets
+        tails = self.tails
+        seen = bytearray(len(self.nodes))
+        order = []
+        depths = []
+        for node in start_nodes:
+            i = self.node_ids.get(node)
+            if i is not None and not seen[i]:
+                seen[i] = 1
+                order.append(i)
+                depths.append(0)
+        pos = 0
+        while pos < len(order):
+            i = order[pos]
+            depth = depths[pos] + 1
+            pos += 1
+            for t in range(tail_offsets[edge_offsets[i]], tail_offsets[edge_offsets[i + 1]]):
+                c = tails[t]
+                if not seen[c]:
+                    seen[c] = 1
+                    order.append(c)
+                    depths.append(depth)
+        return order, depths
+
+    def reach(self, node):
+        """
+        Return the set of nodes on the edges reachable from a node.
+        """
+        if not self.out_degree(node):
+            return set()
+        order, _ = self.traverse((node,))
+        return {self.nodes[i] for i in order}
+
+    def reach_edge_count(self, node):
+        """
+        Return the number of edges reachable from a node.
+        """
+        edge_offsets = self.edge_offsets
+        order, _ = self.traverse((node,))
+        return sum(edge_offsets[i + 1] - edge_offsets[i] for i in order)
@@ -1,8 +1,11 @@
 import re
+from functools import partial
+from multiprocessing import Pool
 
 from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import LexerError, ParserError
 from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.hgraph import Hgraph
 from tuw_nlp.sem.hrg.steps.bolinas.common.nonterminal import NonterminalLabel
+from tuw_nlp.sem.hrg.steps.bolinas.common.symbols import symbols
 
 
 class Lexer(object):
@@ -126,7 +129,7 @@ class GraphDescriptionParser(object):
         else:
             ext_id = None
 
-        return ident, label, ext_id
+        return symbols.intern(ident), symbols.intern(label), ext_id
 
     def parse_string(self, s, concepts=True):
         """
@@ -230,7 +233,7 @@ class GraphDescriptionParser(object):
 
             elif state == 2:
                 if typ == LexTypes.EDGELABEL:
-                    stack.append((EDGE, token[1:]))
+                    stack.append((EDGE, symbols.intern(token[1:])))
                     state = 4
                 elif typ == LexTypes.NODE:
                     stack.append((EDGE, ""))  # No edge specified, assume empty label
@@ -259,7 +262,7 @@ class GraphDescriptionParser(object):
                     stack.append((CNODE, self.parse_node(token)))
                     state = 3
                 elif typ == LexTypes.EDGELABEL:
-                    stack.append((EDGE, token[1:]))
+                    stack.append((EDGE, symbols.intern(token[1:])))
                     state = 4
                 elif typ == LexTypes.LPAR:
                     state = 1
@@ -273,7 +276,7 @@ class GraphDescriptionParser(object):
                     stack.append((CNODE, self.parse_node(token)))
                     state = 3
                 elif typ == LexTypes.EDGELABEL:
-                    stack.append((EDGE, token[1:]))
+                    stack.append((EDGE, symbols.intern(token[1:])))
                 elif typ == LexTypes.RPAR:  # Pop from stack and add edges
                     pop_and_transition();
                 else:
@@ -296,6 +299,30 @@ class GraphDescriptionParser(object):
         return hgraph
 
 
+def _parse_graph(graph_string, errors=False):
+    try:
+        return Hgraph.from_string(graph_string)
+    except Exception as e:
+        if not errors:
+            raise
+        return e
+
+
+def load_graphs(graph_strings, workers=1, chunksize=64, errors=False):
+    """
+    Parse bolinas graph descriptions and yield the hypergraphs in input order.
+    Every process parses with a single GraphDescriptionParser. With more than one
+    worker the strings are parsed in a process pool. With errors=True, a string
+    that cannot be parsed yields its exception instead of raising it.
+    """
+    if workers <= 1:
+        for graph_string in graph_strings:
+            yield _parse_graph(graph_string, errors)
+        return
+    with Pool(workers) as pool:
+        yield from pool.imap(partial(_parse_graph, errors=errors), graph_strings, chunksize)
+
+
 if __name__ == "__main__":
     # Just test the module
     import doctest
@@ -1,7 +1,8 @@
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
 import re
 import sys
 
+from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.adjacency import GraphAdjacency
 from tuw_nlp.sem.hrg.steps.bolinas.common.nonterminal import NonterminalLabel
 
 
@@ -67,7 +68,8 @@ class ListMap(defaultdict):
 
     def __reduce__(self):
         t = defaultdict.__reduce__(self)
-        return (t[0], ()) + t[2:]
+        # items() flattens the value lists, so pickle the lists themselves
+        return (t[0], (), t[2], t[3], iter(dict.items(self)))
 
 
 # Actual AMR class
@@ -81,6 +83,9 @@ class Hgraph(defaultdict):
     A set of (concept, role, filler) triples can be extracted as well.
     """
     _parser_singleton = None
+    __cached_hash = None
+    __cached_canonical_form = None
+    __adjacency = None
 
     def __init__(self, *args, **kwargs):
 
@@ -93,23 +98,34 @@ class Hgraph(defaultdict):
         # to prefix unique new node IDs for glued fragments.
         self.replace_count = 0
 
-        self.__cached_triples = None
+        # the triples with and without node labels
+        self.__cached_triples = {}
         self.__cached_depth = None
-        self.__nodelabels = False
 
         self.node_alignments = {}
         self.edge_alignments = {}
 
-        self.__cached_triples = None
         self.node_to_concepts = {}
 
+        # The structural fingerprint and canonical form are computed when the graph is
+        # first hashed or compared, and reset when a triple is added.
+        self.__cached_hash = None
+        self.__cached_canonical_form = None
+
+        # Built by the first traversal and dropped when a triple is added.
+        self.__adjacency = None
+
     def __reduce__(self):
         t = defaultdict.__reduce__(self)
-        return (t[0], ()) + (self.__dict__,) + t[3:]
+        # the fingerprint depends on the string hashes of this process
+        state = dict(self.__dict__)
+        state["_Hgraph__cached_hash"] = None
+        state["_Hgraph__adjacency"] = None
+        return (t[0], ()) + (state,) + t[3:]
 
     def _get_node_hashes(self):
         tabu = set()
-        queue = []
+        queue = deque()
         node_to_id = defaultdict(int)
         for x in sorted(self.roots):
             if type(x) is tuple:
@@ -120,10 +136,10 @@ class Hgraph(defaultdict):
                 queue.append((x, 0))
                 node_to_id[x] = 0
         while queue:
-            node, depth = queue.pop(0)
+            node, depth = queue.popleft()
             if node not in tabu:
                 tabu.add(node)
-                rels = tuple(sorted(self[node].keys()))
+                rels = tuple(sorted(self[node].keys(), key=str))
                 node_to_id[node] += 13 * depth + hash(rels)
 
                 for rel in rels:
@@ -141,22 +157,59 @@ class Hgraph(defaultdict):
         # We compute a hash for each node in the AMR and then sum up the hashes.
         # Collisions are minimized because each node hash is offset according to its distance from
         # the root.
-        node_to_id = self._get_node_hashes()
-        return sum(node_to_id[node] for node in node_to_id)
+        if self.__cached_hash is None:
+            node_to_id = self._get_node_hashes()
+            self.__cached_hash = sum(node_to_id[node] for node in node_to_id)
+        return self.__cached_hash
+
+    def _canonical_form(self):
+        """
+        The graph with its nodes numbered in the order of a traversal from the roots
+        that visits the edges of a node sorted by label, together with the concepts
+        and external node indices of the numbered nodes.
+        """
+        if self.__cached_canonical_form is None:
+            node_ids = {}
+            edges = []
+            queue = deque()
+            for root in self.roots:
+                if root not in node_ids:
+                    node_ids[root] = len(node_ids)
+                    queue.append(root)
+            while queue:
+                node = queue.popleft()
+                for rel, child in sorted(self[node].items(), key=lambda x: str(x[0])):
+                    child = child if type(child) is tuple else (child,)
+                    for c in child:
+                        if c not in node_ids:
+                            node_ids[c] = len(node_ids)
+                            queue.append(c)
+                    edges.append((node_ids[node], rel, tuple(node_ids[c] for c in child)))
+            nodes = sorted(node_ids, key=node_ids.get)
+            self.__cached_canonical_form = (
+                tuple(node_ids[root] for root in self.roots),
+                tuple(edges),
+                tuple(self.node_to_concepts.get(node) for node in nodes),
+                tuple(self.external_nodes.get(node) for node in nodes),
+            )
+        return self.__cached_canonical_form
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        if self is other:
+            return True
+        if not isinstance(other, Hgraph) or hash(self) != hash(other):
+            return False
+        return self._canonical_form() == other._canonical_form()
 
     @classmethod
     def from_string(cls, amr_string):
         """
         Initialize a new abstract meaning representation from a Pennman style string.
         """
-        if not cls._parser_singleton:  # Initialize the AMR parser only once
+        if not Hgraph._parser_singleton:  # Initialize the AMR parser only once
             from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.graph_description_parser import GraphDescriptionParser
-            _parser_singleton = GraphDescriptionParser()
-            amr = _parser_singleton.parse_string(amr_string)
-            return amr
+            Hgraph._parser_singleton = GraphDescriptionParser()
+        return Hgraph._parser_singleton.parse_string(amr_string)
 
     @classmethod
     def from_triples(cls, triples, concepts, roots=None, warn=sys.stderr):
@@ -208,16 +261,15 @@ class Hgraph(defaultdict):
             graph.roots = graph.find_roots(warn=warn)
 
         graph.node_to_concepts = concepts
-        graph.__cached_triples = None
+        graph.__cached_triples = {}
         return graph
 
     def get_nodes(self):
         """
         Return the set of node identifiers in the DAG.
         """
-        ordered = self.get_ordered_nodes()
-        res = OrderedDict(sorted(ordered.items(), key=lambda x: x[1]))
-        return res
+        # get_ordered_nodes numbers the nodes in insertion order
+        return OrderedDict(self.get_ordered_nodes())
 
     def nonterminal_edges(self):
         """
@@ -247,14 +299,7 @@ class Hgraph(defaultdict):
         """
         Return the set of nodes reachable from a node
         """
-        res = set()
-        for p, r, c in self.triples(start_node=node, instances=False):
-            res.add(p)
-            if type(c) is tuple:
-                res.update(c)
-            else:
-                res.add(c)
-        return res
+        return self.adjacency().reach(node)
 
     def find_roots(self, warn=sys.stderr):
         """
@@ -276,35 +321,24 @@ class Hgraph(defaultdict):
                     children.add(v)
         roots = list(parents - children)
 
+        adjacency = self.adjacency()
         not_found = parents.union(children)
         for r in roots:
-            x = self.triples(start_node=r, instances=False)
-            for p, r, c in x:
-                if p in not_found:
-                    not_found.remove(p)
-                if type(c) is tuple:
-                    for ch in c:
-                        if ch in not_found:
-                            not_found.remove(ch)
-                if c in not_found:
-                    not_found.remove(c)
+            not_found -= adjacency.reach(r)
 
+        edge_counts = {}
         while not_found:
-            parents = sorted([x for x in not_found if self[x]], key=lambda a: len(self.triples(start_node=a)))
+            parents = [x for x in not_found if adjacency.out_degree(x)]
+            for x in parents:
+                if x not in edge_counts:
+                    edge_counts[x] = adjacency.reach_edge_count(x)
+            parents.sort(key=edge_counts.get)
             if not parents:
                 if warn: warn.write("WARNING: orphaned leafs %s.\n" % str(not_found))
                 roots.extend(list(not_found))
                 return roots
             new_root = parents.pop()
-            for p, r, c in self.triples(start_node=new_root):
-                if p in not_found:
-                    not_found.remove(p)
-                if type(c) is tuple:
-                    for ch in c:
-                        if ch in not_found:
-                            not_found.remove(ch)
-                if c in not_found:
-                    not_found.remove(c)
+            not_found -= adjacency.reach(new_root)
             roots.append(new_root)
         return roots
 
@@ -415,46 +449,41 @@ class Hgraph(defaultdict):
         Retrieve a list of (parent, edge-label, tails) triples. 
         """
 
-        if (not (refresh or start_node or nodelabels != self.__nodelabels)) and self.__cached_triples:
-            return self.__cached_triples
+        if not (refresh or start_node) and self.__cached_triples.get(nodelabels):
+            return self.__cached_triples[nodelabels]
+
+        if refresh:
+            self.__adjacency = None
+        adjacency = self.adjacency()
 
         triple_to_depth = {}
         triples = []
-        tabu = set()
 
-        if start_node:
-            queue = [(start_node, 0)]
-        else:
-            queue = [(x, 0) for x in self.roots]
-        while queue:
-            node, depth = queue.pop(0)
-            if not node in tabu:
-                tabu.add(node)
-                for rel, child in sorted(self[node].items(), key=lambda x: str(x[0])):
-                    if nodelabels:
-                        newchild = tuple([(n, self.node_to_concepts[n]) for n in child])
-                        newnode = (node, self.node_to_concepts[node])
-                        t = (newnode, rel, newchild)
-                    else:
-                        t = (node, rel, child)
-
-                    triples.append(t)
-                    triple_to_depth[t] = depth
-                    if type(child) is tuple:
-                        for c in child:
-                            if not c in tabu:
-                                queue.append((c, depth + 1))
-                    else:
-                        if not child in tabu:
-                            queue.append((child, depth + 1))
+        order, depths = adjacency.traverse([start_node] if start_node else self.roots)
+        for i, depth in zip(order, depths):
+            for t in adjacency.out_edges(i):
+                if nodelabels:
+                    node, rel, child = t
+                    newchild = tuple([(n, self.node_to_concepts[n]) for n in child])
+                    newnode = (node, self.node_to_concepts[node])
+                    t = (newnode, rel, newchild)
+                triples.append(t)
+                triple_to_depth[t] = depth
 
         if not start_node:
-            self.__cached_triples = triples
+            self.__cached_triples[nodelabels] = triples
             self.__cached_depth = triple_to_depth
-            self.__nodelabels = nodelabels
 
         return triples
 
+    def adjacency(self):
+        """
+        Return the compact adjacency representation of the graph used by the traversals.
+        """
+        if self.__adjacency is None:
+            self.__adjacency = GraphAdjacency(self)
+        return self.__adjacency
+
     def __str__(self):
         return self.to_bolinas_str()
 
@@ -527,6 +556,10 @@ class Hgraph(defaultdict):
                     if warn: warn.write("WARNING: (%s, %s, %s) produces a cycle with (%s, %s, %s)\n" % (
                         parent, relation, child, c, rel, test))
         self[parent].append(relation, child)
+        self.__cached_triples = {}
+        self.__adjacency = None
+        self.__cached_hash = None
+        self.__cached_canonical_form = None
 
 
 class StrLiteral(str):
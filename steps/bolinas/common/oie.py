@@ -1,13 +1,14 @@
 from collections import Counter
 
 from tuw_nlp.sem.hrg.steps.bolinas.common.output import print_shifted, format_derivation
+from tuw_nlp.sem.hrg.steps.bolinas.common.symbols import symbols
 
 
 def get_labels(derivation):
     if type(derivation) is not tuple:
         if derivation == "START" or derivation.rule.symbol == "S":
             return {}
-        return {derivation.mapping['_1'].split('n')[1]: derivation.rule.symbol}
+        return {derivation.mapped('_1').split('n')[1]: derivation.rule.symbol}
     else:
         ret = {}
         items = [c for (_, c) in derivation[1].items()] + [derivation[0]]
@@ -52,6 +53,6 @@ def extract_for_kth_derivation(derivation, n_score, ki):
     log += f"All used rules: {sum(rules_counter.values())}\n\n"
 
     final_item = derivation[1]["START"][0]
-    nodes = sorted(list(final_item.nodeset), key=lambda node: int(node[1:]))
+    nodes = sorted(final_item.nodes(), key=symbols.node_number)
     log += f"k{ki}:\t{nodes} - {len(nodes)}\n"
     return log, rules_counter, nodes
@@ -5,9 +5,10 @@ from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.hgraph import Hgraph
 
 def print_shifted(derivation):
     final_item = derivation[1]["START"][0]
-    node_to_concepts = dict(zip(final_item.nodeset, [""]*len(final_item.nodeset)))
+    nodes = final_item.nodes()
+    node_to_concepts = dict(zip(nodes, [""]*len(nodes)))
     triples = []
-    for v, l, u in final_item.shifted:
+    for v, l, u in final_item.shifted_edges():
         triples.append((v[0], l, u[0][0]))
     graph = Hgraph.from_triples(triples, node_to_concepts)
     return re.sub(r"(\n|\s+)", " ", graph.to_bolinas_str(nodeids=True))
@@ -0,0 +1,39 @@
+class SymbolTable(object):
+    """
+    Numbers the node ids and labels of the loaded graphs. Every symbol is kept as a
+    single string object, so the graphs, chart items and charts of a process share
+    it instead of holding copies, and lookups by symbol compare by identity.
+    id() numbers a symbol, and the number indexes symbols.
+    """
+
+    def __init__(self):
+        self.symbols = []
+        self.ids = {}
+        self.node_numbers = {}
+
+    def intern(self, symbol):
+        """
+        Returns the shared copy of the symbol, adding it to the table if it is new.
+        """
+        return self.symbols[self.id(symbol)]
+
+    def id(self, symbol):
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return symbol_id
+
+    def node_number(self, node):
+        """
+        Returns the number in a node id like n12, so that nodes can be sorted in
+        sentence order. Parsed once per node id.
+        """
+        number = self.node_numbers.get(node)
+        if number is None:
+            number = self.node_numbers[node] = int(node[1:])
+        return number
+
+
+# The table shared by all graphs loaded in this process.
+symbols = SymbolTable()
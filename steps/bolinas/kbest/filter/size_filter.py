@@ -6,7 +6,7 @@ def get_size_counter(chart):
     graph_sizes = Counter()
     for split in chart["START"]:
         assert len(split.items()) == 1
-        graph_size = len(split["START"].nodeset)
+        graph_size = len(split["START"].nodes())
         graph_sizes[graph_size] += 1
     return graph_sizes
 
@@ -16,7 +16,7 @@ def delete_smaller(chart, boundary_value):
     splits_to_keep = []
     for split in chart["START"]:
         assert len(split.items()) == 1
-        graph_size = len(split["START"].nodeset)
+        graph_size = len(split["START"].nodes())
         if graph_size >= boundary_value:
             splits_to_keep.append(split)
     del ret["START"]
@@ -1,28 +1,29 @@
 import json
 import math
 import os.path
-import pickle
 
 from collections import OrderedDict
 from copy import copy
 
 from tuw_nlp.sem.hrg.common.conll import ConllSen
-from tuw_nlp.sem.hrg.common.script.loop_on_sen_dirs import LoopOnSenDirs
-from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import DerivationException
+from tuw_nlp.sem.hrg.common.script.loop_on_sen_dirs import LoopOnSenDirs, load_grammar
+from tuw_nlp.sem.hrg.steps.bolinas.common.chart import DerivationCache, LazyKBest
+from tuw_nlp.sem.hrg.steps.bolinas.common.chart_file import ChartFile
+from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import ChartFileError, DerivationException
 from tuw_nlp.sem.hrg.steps.bolinas.common.oie import get_labels, extract_for_kth_derivation
 from tuw_nlp.sem.hrg.steps.bolinas.kbest.filter.pr_filter import filter_for_pr
 from tuw_nlp.sem.hrg.steps.bolinas.kbest.filter.size_filter import filter_for_size
 
 
-def get_k_best_unique_derivation(chart, k):
+def get_k_best_unique_derivation(derivations, k):
+    # the derivations of a chart cover node sets of the same graph index,
+    # so they are compared by their bitsets
     kbest_unique_nodes = set()
     kbest_unique_derivations = []
-    for score, derivation in chart:
+    for score, derivation in derivations:
         final_item = derivation[1]["START"][0]
-        nodes = sorted(list(final_item.nodeset), key=lambda node: int(node[1:]))
-        nodes_str = " ".join(nodes)
-        if nodes_str not in kbest_unique_nodes:
-            kbest_unique_nodes.add(nodes_str)
+        if final_item.nodeset not in kbest_unique_nodes:
+            kbest_unique_nodes.add(final_item.nodeset)
             kbest_unique_derivations.append((score, derivation))
         if len(kbest_unique_derivations) >= k:
             break
@@ -54,19 +55,18 @@ class KBest(LoopOnSenDirs):
         super().__init__(description="Script to search k best derivations in parsed charts.", config=config)
         self.logprob = True
         self.score_disorder_collector = {}
+        # the grammars the charts were parsed with, by grammar file
+        self.grammars = {}
 
     def _before_loop(self):
         pass
 
     def _do_for_sen(self, sen_idx, sen_dir):
         bolinas_dir = f"{self.out_dir}/{str(sen_idx)}/bolinas"
-        chart_file = f"{bolinas_dir}/sen{sen_idx}_chart.pickle"
-        if not os.path.exists(chart_file):
+        chart = self._load_chart(bolinas_dir, sen_idx)
+        if chart is None:
             return
 
-        with open(chart_file, "rb") as f:
-            chart = pickle.load(f)
-
         if "START" not in chart:
             print("No derivation found")
             return
@@ -76,6 +76,7 @@ class KBest(LoopOnSenDirs):
             f"{sen_dir}/pos_edge_graph_top_order.json"
         ))
         pos_tags = ConllSen(sen_dir).pos_tags()
+        derivation_cache = DerivationCache()
 
         for name, c in sorted(self.config["filters"].items()):
             if c.get("ignore", False):
@@ -94,7 +95,8 @@ class KBest(LoopOnSenDirs):
                 filtered_chart = filter_for_size(chart, chart_filter)
             sen_log_lines.append(f"Chart 'START' length after size filter: {len(filtered_chart['START'])}\n")
 
-            derivations = filtered_chart.derivations("START")
+            search = LazyKBest(filtered_chart, cache=derivation_cache)
+            derivations = search.iter_derivations("START")
 
             assert ("k" in c and "pr_metric" not in c) or ("k" not in c and "pr_metric" in c)
 
@@ -117,6 +119,9 @@ class KBest(LoopOnSenDirs):
             else:
                 print("Neither 'k' nor 'pr_metric' is set")
                 continue
+            search_summary = search.summary()
+            print(search_summary)
+            sen_log_lines.append(f"{search_summary}\n")
 
             last_score = None
             score_disorder = {}
@@ -168,6 +173,25 @@ class KBest(LoopOnSenDirs):
                 ]
             )
 
+    def _load_chart(self, bolinas_dir, sen_idx):
+        """
+        Load the chart of a sentence. The grammar of the chart is the grammar_file of
+        the config if it is set, and the one recorded in the chart otherwise.
+        Returns None if the sentence has no chart, or if it cannot be loaded.
+        """
+        chart_file = f"{bolinas_dir}/sen{sen_idx}_chart.hrgc"
+        if os.path.exists(chart_file):
+            try:
+                chart_data = ChartFile(chart_file)
+                grammar_file = self._get_grammar_file() if "grammar_file" in self.config \
+                    else chart_data.grammar_file
+                if grammar_file not in self.grammars:
+                    self.grammars[grammar_file] = load_grammar(grammar_file)
+                return chart_data.to_chart(self.grammars[grammar_file])
+            except (ChartFileError, OSError) as e:
+                self._log(f"Could not load the chart of sentence {sen_idx}: {e}", print_to_std=True)
+        return None
+
     def _after_loop(self):
         num_sem = len(self.score_disorder_collector.keys())
         self._log(f"\nNumber of sentences: {num_sem}")
@@ -1,49 +1,171 @@
-import fileinput
-import pickle
+import json
 
-from tuw_nlp.sem.hrg.common.script.loop_on_sen_dirs import LoopOnSenDirs
-from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.hgraph import Hgraph
+from tuw_nlp.sem.hrg.common.script.loop_on_sen_dirs import LoopOnSenDirs, load_grammar
+from tuw_nlp.sem.hrg.steps.bolinas.common.chart_file import write_chart
+from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import ParseTooLongException
+from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.graph_description_parser import load_graphs
 from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.parser import Parser
 
 
+def parse_sen(parser, graph_file, chart_file, incremental=False, chart_codec=None):
+    """
+    Parse the graph in graph_file and save the chart to chart_file, compressed with
+    chart_codec if it is set.
+    Returns the lines of the sentence log, whether the parse finished, and the
+    budget that truncated the parse, if any.
+    """
+    sen_log_lines = []
+    truncated = None
+    with open(graph_file) as f:
+        parse_generator = parser.parse_graphs(
+            load_graphs(f),
+            partial=True,
+            incremental=incremental,
+        )
+        try:
+            for i, (chart, parse_logs) in enumerate(parse_generator):
+                assert i == 0
+                truncated = chart.truncated
+                if "START" not in chart:
+                    sen_log_lines.append("No derivation found\n")
+                    if truncated:
+                        sen_log_lines.append(f"Truncated: {truncated}\n")
+                    continue
+                else:
+                    sen_log_lines.append(f"{parse_logs}\n")
+                    write_chart(chart_file, chart, parser.grammar, chart_codec)
+        except ParseTooLongException as e:
+            sen_log_lines.append(e.print_message())
+            return sen_log_lines, False, None
+    return sen_log_lines, True, truncated
+
+
+# Each worker process of the pool loads the grammar and builds its parser once.
+_worker_parser = None
+_worker_incremental = False
+_worker_chart_codec = None
+
+
+def _init_worker(grammar_file, parser_args, incremental, chart_codec):
+    global _worker_parser, _worker_incremental, _worker_chart_codec
+    _worker_parser = Parser(load_grammar(grammar_file), **parser_args)
+    _worker_incremental = incremental
+    _worker_chart_codec = chart_codec
+
+
+def _parse_sen_in_worker(graph_file, chart_file):
+    return parse_sen(_worker_parser, graph_file, chart_file, _worker_incremental, _worker_chart_codec)
+
+
 class Parse(LoopOnSenDirs):
 
     def __init__(self, config=None):
         super().__init__(description="Script to parse graph inputs and save parsed chars.", config=config)
         self.grammar = None
         self.parser = None
+        self.incremental = self.config.get("incremental_chart", False)
+        self.chart_codec = self.config.get("chart_codec")
+        # the budgets are per sentence: max_time in seconds, and max_memory in MB of
+        # resident memory the parse of one sentence may add to the process
+        self.parser_args = dict(
+            max_steps=self.config.get("max_steps", 10000),
+            agenda=self.config.get("agenda", "bfs"),
+            beam=self.config.get("beam"),
+            max_time=self.config.get("max_time"),
+            max_memory=self.config.get("max_memory"),
+        )
+        # (finished, truncated) of the last parse of every sentence
+        self.sen_results = {}
 
     def _before_loop(self):
         self._load_grammar()
-        self.parser = Parser(self.grammar, max_steps=self.config.get("max_steps", 10000))
+        if self.workers <= 1:
+            self.parser = Parser(self.grammar, **self.parser_args)
 
-    def _do_for_sen(self, sen_idx, sen_dir):
-        bolinas_dir = self._get_subdir("bolinas", parent_dir=f"{self.out_dir}/{str(sen_idx)}")
-        self._parse_sen(
-            graph_file=f"{sen_dir}/pos_edge.graph",
-            chart_file=f"{bolinas_dir}/sen{str(sen_idx)}_chart.pickle",
-            sen_log_file=f"{bolinas_dir}/sen{str(sen_idx)}_parse.log",
+    def _run_loop(self):
+        sen_range = self._get_range()
+        deepening = self.config.get("deepening")
+        if deepening and not self.parser_args["max_steps"]:
+            # without a step budget no parse is truncated by max_steps
+            self._log("Deepening is skipped, max_steps is not set", print_to_std=True)
+            deepening = None
+        if not deepening:
+            self._run_pass(sen_range)
+        else:
+            self._run_deepening(sen_range, deepening.get("factor", 4), deepening["max_steps"])
+        if sen_range:
+            self.first_sen_to_proc = sen_range[0]
+            self.last_sen_to_proc = sen_range[-1]
+
+    def _run_deepening(self, sen_range, factor, max_steps_cap):
+        """
+        Parse all sentences with the max_steps of the config first, then parse the
+        ones truncated by max_steps again with factor times the steps, until none
+        is truncated or the cap is reached. Every pass starts the parse over, but
+        as the budget grows geometrically, the earlier passes add at most
+        1 / (factor - 1) to the steps of the last one.
+        """
+        max_steps = self.parser_args["max_steps"]
+        while sen_range:
+            self._run_pass(sen_range)
+            truncated = [sen_idx for sen_idx in sen_range if self.sen_results[sen_idx][1] == "max_steps"]
+            self._log(f"Pass with max_steps {max_steps}: {len(sen_range)} sentences, {len(truncated)} truncated",
+                      print_to_std=True)
+            if max_steps >= max_steps_cap:
+                break
+            max_steps = min(max_steps * factor, max_steps_cap)
+            self.parser_args["max_steps"] = max_steps
+            if self.parser is not None:
+                self.parser.max_steps = max_steps
+            sen_range = truncated
+
+    def _run_pass(self, sen_range):
+        if self.workers <= 1:
+            self._run_sen_loop(sen_range)
+            return
+
+        # Sentences are parsed in a pool of worker processes, and finish in any order.
+        # The output files of every sentence are fixed, and the run log is sorted.
+        sen_files = dict((sen_idx, self._get_sen_files(sen_idx)) for sen_idx in sen_range)
+        results = self._run_in_pool(
+            _parse_sen_in_worker,
+            [(sen_idx, files[:2]) for sen_idx, files in sen_files.items()],
+            initializer=_init_worker,
+            initargs=(self._get_grammar_file(), self.parser_args, self.incremental, self.chart_codec),
         )
+        for sen_idx, result in results:
+            print(f"\nProcessed folder {sen_idx}")
+            self._save_sen_result(sen_idx, sen_files[sen_idx][2], result)
 
-    def _parse_sen(self, graph_file, chart_file, sen_log_file):
-        sen_log_lines = []
-        parse_generator = self.parser.parse_graphs(
-            (Hgraph.from_string(x) for x in fileinput.input(graph_file)),
-            partial=True,
+    def _get_sen_files(self, sen_idx):
+        bolinas_dir = self._get_subdir("bolinas", parent_dir=f"{self.out_dir}/{str(sen_idx)}")
+        return (
+            f"{self.in_dir}/{str(sen_idx)}/pos_edge.graph",
+            f"{bolinas_dir}/sen{str(sen_idx)}_chart.hrgc",
+            f"{bolinas_dir}/sen{str(sen_idx)}_parse.log",
         )
 
-        for i, (chart, parse_logs) in enumerate(parse_generator):
-            assert i == 0
-            if "START" not in chart:
-                self._log("No derivation found", sen_log_lines)
-                continue
-            else:
-                self._log(parse_logs, sen_log_lines)
-                with open(chart_file, "wb") as f:
-                    pickle.dump(chart, f, -1)
+    def _do_for_sen(self, sen_idx, sen_dir):
+        graph_file, chart_file, sen_log_file = self._get_sen_files(sen_idx)
+        result = parse_sen(self.parser, graph_file, chart_file, self.incremental, self.chart_codec)
+        self._save_sen_result(sen_idx, sen_log_file, result)
+
+    def _save_sen_result(self, sen_idx, sen_log_file, result):
+        sen_log_lines, finished, truncated = result
+        self.sen_results[sen_idx] = (finished, truncated)
         with open(sen_log_file, "w") as f:
             f.writelines(sen_log_lines)
 
+    def _after_loop(self):
+        parse_did_not_finish = sorted(sen_idx for sen_idx, (finished, _) in self.sen_results.items() if not finished)
+        summary = f"\nNumber of parse did not finish: {len(parse_did_not_finish)}\n" \
+                  f"{json.dumps(parse_did_not_finish)}"
+        for budget in ["max_steps", "max_time", "max_memory"]:
+            truncated = sorted(sen_idx for sen_idx, (_, t) in self.sen_results.items() if t == budget)
+            summary += f"\nNumber of truncated by {budget}: {len(truncated)}\n{json.dumps(truncated)}"
+        self._log(summary, print_to_std=True)
+        super()._after_loop()
+
 
 if __name__ == "__main__":
     Parse().run()
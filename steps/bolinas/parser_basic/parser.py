@@ -1,11 +1,14 @@
+import heapq
+import resource
+import sys
 import time
 from collections import defaultdict, deque
 
 from ordered_set import OrderedSet
 
 from tuw_nlp.sem.hrg.steps.bolinas.common.chart import Chart
-from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import ParseTooLongException, CkyTooLongException
-from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.vo_item import HergItem
+from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import ParseTooLongException
+from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.vo_item import GraphIndex, HergItem
 
 
 class Parser:
@@ -16,30 +19,51 @@ class Parser:
     a CKY parser).
     """
 
-    def __init__(self, grammar, stop_at_first=False, max_steps=None, permutations=False):
+    def __init__(self, grammar, stop_at_first=False, max_steps=None, permutations=False, agenda="bfs", beam=None,
+                 max_time=None, max_memory=None):
         self.grammar = grammar
         self.nodelabels = grammar.nodelabels
+        # budgets per graph: steps, seconds, and MB of resident memory the parse may
+        # add to the process. The memory budget counts the growth during each parse,
+        # because the memory freed after an earlier parse is not returned to the OS.
         self.max_steps = max_steps
+        self.max_time = max_time
+        self.max_memory = max_memory
         self.stop_at_first = stop_at_first
         self.permutations = permutations
+        assert agenda in ["bfs", "best_first"]
+        self.agenda = agenda
+        self.estimates = get_item_estimates(grammar) if agenda == "best_first" else None
+        # keep at most this many closed items per nonterminal symbol and node set
+        self.beam = beam
 
-    def parse_graphs(self, graph_iterator, partial=False):
+    def parse_graphs(self, graph_iterator, partial=False, incremental=False):
         """
         Parse all the graphs in graph_iterator.
+        If incremental is set, the parse chart is built while parsing instead of
+        converting the parser's back-pointers afterwards.
         This is a generator.
         """
         for graph in graph_iterator:
             log = ""
-            raw_chart, parse_log = self.parse(graph, partial=partial)
-            log += parse_log
-            chart, cky_log = get_cky_chart(raw_chart, self.permutations)
+            if incremental:
+                cky_builder, parse_log, truncated = self.parse(graph, partial=partial, incremental=True)
+                log += parse_log
+                chart, cky_log = cky_builder.get_chart()
+            else:
+                raw_chart, parse_log, truncated = self.parse(graph, partial=partial)
+                log += parse_log
+                chart, cky_log = get_cky_chart(raw_chart, self.permutations)
+            chart.truncated = truncated
             log += cky_log
             log += f"\n{chart.log_length()}"
             yield chart, log
 
-    def parse(self, graph, partial=False):
+    def parse(self, graph, partial=False, incremental=False):
         """
         Parses the given string and/or graph.
+        Returns the parser's back-pointers, or an IncrementalCkyChart if incremental is set,
+        the parse log, and the name of the budget that stopped the parse early, or None.
         """
 
         # This is a long function, so let's start with a high-level overview. This is
@@ -47,56 +71,107 @@ class Parser:
         # for each rule, and combine these items with each other and with fragments of
         # the object(s) being parsed to deduce new items. We can think of these items
         # as defining a search space in which we need to find a path to the goal item.
-        # The parser implemented here performs a BFS of this search space.
+        # The parser implemented here performs a BFS of this search space, or, with the
+        # best_first agenda, visits the items with the best score estimate first.
 
         grammar = self.grammar
 
         parse_log = ""
         start_time = time.time()
-        graph_size = len(graph.triples(nodelabels=self.nodelabels))
+        start_rss = current_rss_mb() if self.max_memory else None
 
         # initialize data structures and lookups
         # we use various tables to provide constant-time lookup of fragments available
         # for shifting, completion, etc.
-        chart = defaultdict(set)
+        if incremental:
+            chart = IncrementalCkyChart(self.permutations)
+            add_production = chart.add
+        else:
+            chart = defaultdict(set)
+            add_production = lambda nitem, production: chart[nitem].add(production)
 
         pgrammar = [grammar[r] for r in grammar.reachable_rules(graph, None)]
 
-        queue = deque()
+        graph_index = GraphIndex(graph.triples(nodelabels=self.nodelabels), nodelabels=self.nodelabels)
+        best_first = self.agenda == "best_first"
+        # inside scores are only needed to order or prune items
+        track_inside = best_first or bool(self.beam)
+        inside = {}
+        queue = BestFirstAgenda(self.estimates, inside) if best_first else deque()
         pending = set()
-        attempted = set()
         visited = set()
+        # Closed items and items waiting for a nonterminal are indexed by the key
+        # of HergItem.waiting_key, so that completion only considers items that
+        # agree on the symbol and on the graph nodes already mapped. For every
+        # symbol, attachment_masks holds the combinations of mapped attachment
+        # nodes that items of pgrammar can wait with.
+        # Items enter the lookups when they are visited, and every item is visited
+        # once. A waiting item is completed with the closed items already in the
+        # lookup, and a closed item with the waiting items already in the lookup,
+        # so every pair of items is tried exactly once.
         nonterminal_lookup = defaultdict(OrderedSet)
-        reverse_lookup = defaultdict(OrderedSet)
-        edge_terminal_lookup = defaultdict(set)
-        for edge in graph.triples(nodelabels=self.nodelabels):
-            edge_terminal_lookup[edge[1]].add(edge)
+        reverse_lookup = defaultdict(list)
+        attachment_masks = defaultdict(set)
+        beam_lookup = defaultdict(list)
+
+        for rule in pgrammar:
+            for position in rule.rhs1_positions:
+                if position.is_nonterminal:
+                    attachment_masks[position.symbol].add(position.bound)
 
         for rule in pgrammar:
-            axiom = HergItem(rule, nodelabels=self.nodelabels)
+            axiom = HergItem(rule, graph_index=graph_index)
+            if track_inside:
+                update_inside(inside, axiom, rule.weight)
             queue.append(axiom)
             pending.add(axiom)
-            if axiom.outside_is_nonterminal:
-                reverse_lookup[axiom.outside_symbol].add(axiom)
 
         max_queue_size = 0
         max_queue_diff_comp = 0
         max_queue_diff_outside_nt = 0
         max_queue_diff_shift = 0
         steps = 0
+        attempted = 0
+        beam_pruned = 0
+        beam_count = 0
+
+        def complete(item, oitem):
+            """
+            Complete the waiting item with the closed oitem, and queue the result.
+            """
+            if item.shifted & oitem.shifted:
+                # items that overlap in the graph never complete
+                return
+            if not item.can_complete(oitem):
+                return
+            nitem = item.complete(oitem)
+            add_production(nitem, (item, oitem))
+            if track_inside:
+                update_inside(inside, nitem, inside[item] + inside[oitem])
+            if nitem not in pending and nitem not in visited:
+                queue.append(nitem)
+                pending.add(nitem)
 
         # parse
+        truncated = None
         while queue:
             if self.max_steps and steps >= self.max_steps:
+                truncated = "max_steps"
+                break
+            if self.max_time and time.time() - start_time > self.max_time:
+                truncated = "max_time"
+                break
+            if self.max_memory and steps % 1000 == 0 and current_rss_mb() - start_rss > self.max_memory:
+                truncated = "max_memory"
                 break
             if steps % 5000 == 0 and steps > 0:
                 print(f"\nstep {steps}")
                 print(f"len queue: {len(queue)}")
                 print(f"len pending: {len(pending)}")
-                print(f"len attempted: {len(attempted)}")
+                print(f"attempted completions: {attempted}")
                 print(f"len visited: {len(visited)}")
 
-            if len(attempted) > 20000000 and len(queue) > 5000:
+            if attempted > 20000000 and len(queue) > 5000:
                 raise ParseTooLongException(steps, queue, attempted)
 
             steps += 1
@@ -109,28 +184,48 @@ class Parser:
             visited.add(item)
 
             if item.closed:
+                if self.beam:
+                    # Only the best closed items for each nonterminal and node set are
+                    # used for further completions. If the beam is full, the new item
+                    # either replaces the worst one or is pruned itself.
+                    kept = beam_lookup[item.rule.symbol, item.nodeset]
+                    beam_count += 1
+                    entry = (inside[item], beam_count, item)
+                    if len(kept) < self.beam:
+                        heapq.heappush(kept, entry)
+                    elif entry[0] > kept[0][0]:
+                        evicted = heapq.heapreplace(kept, entry)[2]
+                        for bound in attachment_masks[evicted.rule.symbol]:
+                            key = evicted.completion_key(bound)
+                            if key is not None:
+                                nonterminal_lookup[key].discard(evicted)
+                        beam_pruned += 1
+                    else:
+                        beam_pruned += 1
+                        continue
+
                 # check if it's a complete derivation
-                if self.successful_parse(item, graph_size):
-                    chart['START'].add((item,))
+                if self.successful_parse(item, graph_index):
+                    add_production('START', (item,))
                     if self.stop_at_first:
                         break
                 elif partial and self.grammar.start_symbol == item.rule.symbol:
-                    chart['START'].add((item,))
+                    add_production('START', (item,))
 
-                # add to nonterminal lookup
-                nonterminal_lookup[item.rule.symbol].add(item)
-
-                # wake up any containing rules
-                # Unlike in ordinary state-space search, it's possible that we will have
-                # to re-visit items which couldn't be merged with anything the first time
-                # we saw them, and are waiting for the current item. The reverse_lookup
-                # indexes all items by their outside symbol, so we re-append to the queue
-                # all items looking for something with the current item's symbol.
+                # add to nonterminal lookup, and complete any containing rules
+                # Unlike in ordinary state-space search, items visited earlier may be
+                # waiting for the current item. The reverse_lookup indexes them by their
+                # outside symbol and mapped attachment nodes, so we complete all items
+                # that may take the current item.
                 before = len(queue)
-                for ritem in reverse_lookup[item.rule.symbol]:
-                    if ritem not in pending:
-                        queue.append(ritem)
-                        pending.add(ritem)
+                for bound in attachment_masks[item.rule.symbol]:
+                    key = item.completion_key(bound)
+                    if key is None:
+                        continue
+                    nonterminal_lookup[key].add(item)
+                    for ritem in reverse_lookup[key]:
+                        attempted += 1
+                        complete(ritem, item)
                 after = len(queue)
                 if (after - before) > max_queue_diff_comp:
                     max_queue_diff_comp = after - before
@@ -138,21 +233,13 @@ class Parser:
             else:
                 if item.outside_is_nonterminal:
                     # complete
-                    reverse_lookup[item.outside_symbol].add(item)
+                    key = item.waiting_key()
+                    reverse_lookup[key].append(item)
 
                     before = len(queue)
-                    for oitem in nonterminal_lookup[item.outside_symbol]:
-                        if (item, oitem) in attempted:
-                            # don't repeat combinations we've tried before
-                            continue
-                        attempted.add((item, oitem))
-                        if not item.can_complete(oitem):
-                            continue
-                        nitem = item.complete(oitem)
-                        chart[nitem].add((item, oitem))
-                        if nitem not in pending and nitem not in visited:
-                            queue.append(nitem)
-                            pending.add(nitem)
+                    for oitem in nonterminal_lookup[key]:
+                        attempted += 1
+                        complete(item, oitem)
                     after = len(queue)
                     if (after - before) > max_queue_diff_outside_nt:
                         max_queue_diff_outside_nt = after - before
@@ -160,13 +247,13 @@ class Parser:
                 else:
                     # shift
                     assert graph
-                    new_items = [item.shift(edge) for edge in
-                                 edge_terminal_lookup[item.outside_edge] if
-                                 item.can_shift(edge)]
+                    new_items = [item.shift(edge) for edge in item.shift_candidates() if item.can_shift(edge)]
 
                     before = len(queue)
                     for nitem in new_items:
-                        chart[nitem].add((item,))
+                        add_production(nitem, (item,))
+                        if track_inside:
+                            update_inside(inside, nitem, inside[item])
                         if nitem not in pending and nitem not in visited:
                             queue.append(nitem)
                             pending.add(nitem)
@@ -178,24 +265,103 @@ class Parser:
         parsing_summary = f"Parsing: {elapsed_time} sec, {steps} steps"
         print(f"\n{parsing_summary}")
         parse_log += f"{parsing_summary}\n"
+        if truncated:
+            budget = getattr(self, truncated)
+            parse_log += f"Truncated: {truncated} budget of {budget} reached\n"
+        parse_log += f"Agenda: {self.agenda}\n"
+        if self.beam:
+            parse_log += f"Beam: {self.beam}, pruned {beam_pruned} closed items\n"
         parse_log += f"Max queue size: {max_queue_size}\n"
         parse_log += f"Max queue diff comp: {max_queue_diff_comp}\n"
         parse_log += f"Max queue diff outside nt: {max_queue_diff_outside_nt}\n"
         parse_log += f"Max queue diff shift: {max_queue_diff_shift}\n"
 
-        return chart, parse_log
+        return chart, parse_log, truncated
 
-    def successful_parse(self, item, graph_size):
+    def successful_parse(self, item, graph_index):
         """
         Determines whether the given item represents a complete derivation of the
         object(s) being parsed.
         """
         if self.grammar.start_symbol != item.rule.symbol:
             return False
-        return len(item.shifted) == graph_size
+        return item.shifted == graph_index.all_edges
+
+
+def current_rss_mb():
+    """
+    The resident memory of this process in MB. Read from /proc where available,
+    elsewhere the peak resident memory is used, so the memory budget only counts
+    what a parse adds beyond the peak of the earlier ones.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes on Linux
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def update_inside(inside, item, score):
+    """
+    Record score as the inside score of item if it is the best one seen so far.
+    The inside score of an item is the best sum of rule weights it has been
+    derived with.
+    """
+    if score > inside.get(item, float("-inf")):
+        inside[item] = score
+
+
+def get_item_estimates(grammar):
+    """
+    For every rule and visit position, estimate the best score that can still be
+    added to an item: the best inside scores of the nonterminals it has yet to
+    complete plus the outside estimate of the rule's symbol.
+    Returns None if the grammar has no finite estimates.
+    """
+    score_estimates = grammar.score_estimates()
+    if score_estimates is None:
+        return None
+    inside, outside = score_estimates
+    estimates = {}
+    for rule in grammar.values():
+        remaining = [outside[rule.symbol]]
+        for position in reversed(rule.rhs1_positions):
+            remaining.append(remaining[-1] + (inside[position.symbol] if position.is_nonterminal else 0.0))
+        estimates[rule.rule_id] = remaining[::-1]
+    return estimates
+
+
+class BestFirstAgenda:
+    """
+    A replacement for the parser's BFS queue that pops the item with the best
+    inside score plus estimate first. The inside scores are kept up to date
+    by the parser in the given dict.
+
+    The estimates come from get_item_estimates. If the grammar has none, items
+    are ordered by their inside score only.
+    """
+
+    def __init__(self, estimates, inside):
+        self.estimates = estimates
+        self.inside = inside
+        self.heap = []
+        self.count = 0
+
+    def append(self, item):
+        priority = self.inside[item]
+        if self.estimates is not None:
+            priority += self.estimates[item.rule.rule_id][item.size]
+        # the counter keeps items with equal priority in FIFO order
+        heapq.heappush(self.heap, (-priority, self.count, item))
+        self.count += 1
 
+    def popleft(self):
+        return heapq.heappop(self.heap)[2]
 
-cky_steps = 0
+    def __len__(self):
+        return len(self.heap)
 
 
 def get_cky_chart(chart, permutations):
@@ -203,42 +369,41 @@ def get_cky_chart(chart, permutations):
     Convert the chart returned by the parser into a standard parse chart.
     """
     start_time = time.time()
-    global cky_steps
-    cky_steps = 0
-
-    def search_productions(citem, chart):
-        global cky_steps
-        cky_steps += 1
-        if round(time.time() - start_time, 2) > 60:
-            raise CkyTooLongException(cky_steps)
-        if len(chart[citem]) == 0:
-            return []
-        if citem == "START":
-            return [{"START": child[0]} for child in chart[citem]]
-
-        prodlist = list(chart[citem])
-
-        lengths = set(len(x) for x in prodlist)
-        assert len(lengths) == 1
-        split_len = lengths.pop()
-
-        # figure out all items that could have been used to complete this nonterminal
-        if split_len != 1:
-            assert split_len == 2
-            symbol = prodlist[0][0].outside_symbol, prodlist[0][0].outside_nt_index
-            result = []
-            for child in prodlist:
-                other_nts = search_productions(child[0], chart)
-                if other_nts:
-                    for option in other_nts:
-                        d = dict(option)
-                        d[symbol] = child[1]
-                        result.append(d)
-                else:
-                    result.append(dict([(symbol, child[1])]))
-            return result
+    steps = 0
+
+    # The completions that lead to an item are stored as back-pointer chains
+    # (previous chain, nonterminal, completing item), so an item shares the chains
+    # of the item it was built from. Every item is expanded only once, and the
+    # chains are only turned into productions for closed items.
+    completions = {}
+
+    def search_completions(citem):
+        nonlocal steps
+        if citem in completions:
+            return completions[citem]
+        steps += 1
+        prodlist = list(chart.get(citem, ()))
+        if not prodlist:
+            # axiom, nothing has been completed yet
+            result = [None]
         else:
-            return search_productions(prodlist[0][0], chart)
+            lengths = set(len(x) for x in prodlist)
+            assert len(lengths) == 1
+            split_len = lengths.pop()
+
+            # figure out all items that could have been used to complete this nonterminal
+            if split_len != 1:
+                assert split_len == 2
+                symbol = prodlist[0][0].outside_symbol, prodlist[0][0].outside_nt_index
+                result = [
+                    (chain, symbol, child[1])
+                    for child in prodlist
+                    for chain in search_completions(child[0])
+                ]
+            else:
+                result = search_completions(prodlist[0][0])
+        completions[citem] = result
+        return result
 
     stack = ['START']
     visit_items = set()
@@ -247,16 +412,18 @@ def get_cky_chart(chart, permutations):
         if item in visit_items:
             continue
         visit_items.add(item)
-        for production in chart[item]:
+        for production in chart.get(item, ()):
             for citem in production:
                 stack.append(citem)
 
     cky_chart = Chart()
     for item in visit_items:
-        if not (item == 'START' or item.closed):
+        if item == 'START':
+            prods = [{"START": child[0]} for child in chart['START']]
+        elif item.closed:
+            prods = [chain_to_production(chain) for chain in search_completions(item) if chain is not None]
+        else:
             continue
-
-        prods = search_productions(item, chart)
         if prods:
             if permutations:
                 cky_chart[item] = prods
@@ -264,21 +431,119 @@ def get_cky_chart(chart, permutations):
                 unique_prods = filter_permutations(prods)
                 cky_chart[item] = unique_prods
     elapsed_time = round(time.time() - start_time, 2)
-    cky_summary = f"Cky conversion: {elapsed_time} sec, {cky_steps} steps"
+    cky_summary = f"Cky conversion: {elapsed_time} sec, {steps} steps"
     print(cky_summary)
     return cky_chart, f"\n{cky_summary}\n"
 
 
+def chain_to_production(chain):
+    """
+    Turn a back-pointer chain of completions into a production dict.
+    """
+    completed = []
+    while chain is not None:
+        chain, symbol, oitem = chain
+        completed.append((symbol, oitem))
+    return dict(reversed(completed))
+
+
+class IncrementalCkyChart:
+    """
+    Builds the standard parse chart while the parser runs, so the parser's
+    back-pointers do not have to be stored and converted by get_cky_chart.
+
+    Completions are kept as the same back-pointer chains get_cky_chart uses.
+    New chains of an item are pushed forward to the items already built on it.
+    """
+
+    def __init__(self, permutations):
+        self.permutations = permutations
+        self.start_items = OrderedSet()
+        self.completions = {}
+        self.successors = defaultdict(list)
+
+    def add(self, nitem, production):
+        """
+        Record that nitem was built from production: (item,) for a shift or
+        a START item, (item, oitem) for a complete.
+        """
+        if nitem == "START":
+            self.start_items.add(production[0])
+            return
+        item = production[0]
+        if len(production) == 1:
+            # like get_cky_chart, follow only the first item a shifted item was built from
+            if nitem in self.completions:
+                return
+            # a shift does not add a completion, so both items share the same chains
+            chains = self.completions[nitem] = self.completions.setdefault(item, [None])
+            self.successors[item].append((chains, self._successors_of(nitem), None, None))
+        else:
+            symbol, oitem = (item.outside_symbol, item.outside_nt_index), production[1]
+            # nitem may be a copy of an existing item, so only the lists it maps to are kept
+            chains = self.completions.setdefault(nitem, [])
+            successors = self._successors_of(nitem)
+            self.successors[item].append((chains, successors, symbol, oitem))
+            new_chains = [(chain, symbol, oitem) for chain in self.completions.get(item, [None])]
+            chains.extend(new_chains)
+            self._propagate(successors, new_chains)
+
+    def _successors_of(self, item):
+        # closed items are never extended
+        return None if item.closed else self.successors[item]
+
+    def _propagate(self, successors, new_chains):
+        """
+        Push the chains just added to an item to the items that were already built on it.
+        """
+        if not successors:
+            return
+        for chains, next_successors, symbol, oitem in successors:
+            if symbol is None:
+                self._propagate(next_successors, new_chains)
+            else:
+                successor_chains = [(chain, symbol, oitem) for chain in new_chains]
+                chains.extend(successor_chains)
+                self._propagate(next_successors, successor_chains)
+
+    def get_chart(self):
+        """
+        Return the parse chart of the items reachable from START.
+        """
+        start_time = time.time()
+        cky_chart = Chart()
+        if self.start_items:
+            cky_chart['START'] = [{"START": item} for item in self.start_items]
+        stack = list(self.start_items)
+        visit_items = set()
+        while stack:
+            item = stack.pop()
+            if item in visit_items:
+                continue
+            visit_items.add(item)
+            prods = [chain_to_production(chain) for chain in self.completions.get(item, ()) if chain is not None]
+            if not prods:
+                continue
+            if not self.permutations:
+                prods = filter_permutations(prods)
+            cky_chart[item] = prods
+            for prod in prods:
+                stack.extend(prod.values())
+        elapsed_time = round(time.time() - start_time, 2)
+        cky_summary = f"Cky conversion: {elapsed_time} sec, incremental"
+        print(cky_summary)
+        return cky_chart, f"\n{cky_summary}\n"
+
+
 def filter_permutations(prods):
     unique_prods = []
     seen_combinations = set()
     for prod in prods:
-        rules = sorted([f"r{item.rule.rule_id}" for item in prod.values()])
-        nodes = []
+        rules = tuple(sorted(item.rule.rule_id for item in prod.values()))
+        nodes = 0
         for item in prod.values():
-            nodes += set(item.nodeset)
-        nodes = sorted(set(nodes))
-        combination = "_".join(rules + nodes)
+            nodes |= item.nodeset
+        combination = (rules, nodes)
         if combination not in seen_combinations:
             seen_combinations.add(combination)
             unique_prods.append(prod)
@@ -11,11 +11,64 @@
 # In consuming this object, we either "shift" a terminal element or "complete" a
 # nonterminal (actually a closed chart item). Each of these steps produces a new
 # chart item.
-from tuw_nlp.sem.hrg.steps.bolinas.common.nonterminal import NonterminalLabel
+
+from collections import defaultdict
+
+from tuw_nlp.sem.hrg.steps.bolinas.parser_basic.vo_rule import shift_pattern
 
 
 class Item(object):
-    pass
+    __slots__ = ()
+
+
+class GraphIndex(object):
+    """
+    Numbers the edges and nodes of an input graph, so that the parts of the graph
+    an item covers can be stored as int bitsets, and items map rule nodes to node
+    numbers. edge_nodes holds the numbers of the head and tail nodes of an edge.
+    Also indexes the edges for shifting: shift_lookup maps the shift_pattern of
+    an edge to its edges, and (shift_pattern, head number) to the ones with that head.
+    """
+
+    def __init__(self, edges, nodelabels=False):
+        self.edges = []
+        self.edge_bits = {}
+        self.edge_nodes = {}
+        self.nodes = []
+        self.node_numbers = {}
+        shift_lookup = defaultdict(list)
+        for edge in edges:
+            if edge in self.edge_bits:
+                continue
+            self.edge_bits[edge] = 1 << len(self.edges)
+            self.edges.append(edge)
+            head = edge[0][0] if nodelabels else edge[0]
+            tails = tuple(x[0] for x in edge[2]) if nodelabels else tuple(edge[2])
+            for node in (head,) + tails:
+                if node not in self.node_numbers:
+                    self.node_numbers[node] = len(self.nodes)
+                    self.nodes.append(node)
+            self.edge_nodes[edge] = tuple(self.node_numbers[node] for node in (head,) + tails)
+            pattern = shift_pattern(edge, nodelabels)
+            shift_lookup[pattern, None].append(edge)
+            shift_lookup[pattern, self.node_numbers[head]].append(edge)
+        self.shift_lookup = dict(shift_lookup)
+        self.all_edges = (1 << len(self.edges)) - 1
+
+    @staticmethod
+    def _decode(bits, elements):
+        decoded = []
+        while bits:
+            low = bits & -bits
+            decoded.append(elements[low.bit_length() - 1])
+            bits ^= low
+        return decoded
+
+    def decode_edges(self, bits):
+        return self._decode(bits, self.edges)
+
+    def decode_nodes(self, bits):
+        return self._decode(bits, self.nodes)
 
 
 class HergItem(Item):
@@ -23,134 +76,164 @@ class HergItem(Item):
     Chart item for a HRG parse.
     """
 
-    def __init__(self, rule, size=None, shifted=None, mapping=None, nodeset=None, nodelabels=False):
+    # Millions of items are alive during a parse, so they only keep what differs
+    # between them. Everything about the outside of the item comes from the
+    # visit position precomputed on the rule, and the mapping is a tuple of the
+    # numbers of graph nodes in graph_index, indexed by the position of the rule
+    # node in rule.rhs1_nodes.
+    __slots__ = ("rule", "size", "shifted", "mapping", "nodeset", "graph_index", "outside", "key", "__cached_hash")
+
+    def __init__(self, rule, size=None, shifted=None, mapping=None, nodeset=None, graph_index=None):
         # by default start empty, with no part of the graph consumed
         if size == None:
             size = 0
         if shifted == None:
-            shifted = frozenset()
+            shifted = 0
         if mapping == None:
-            mapping = dict()
+            mapping = (None,) * len(rule.rhs1_nodes)
         if nodeset == None:
-            nodeset = frozenset()
+            nodeset = 0
 
         self.rule = rule
         self.size = size
+        # shifted edges and covered nodes are bitsets over graph_index
         self.shifted = shifted
         self.mapping = mapping
         self.nodeset = nodeset
+        self.graph_index = graph_index
+
+        # None if this item is closed
+        self.outside = rule.rhs1_positions[size] if size < len(rule.rhs1_positions) else None
+
+        # the canonical key identifies the item in sets, dicts and sorting
+        self.key = (rule.rule_id, size, shifted, mapping)
+        self.__cached_hash = hash(self.key)
+
+    @property
+    def nodelabels(self):
+        return self.rule.nodelabels
+
+    @property
+    def closed(self):
+        return self.outside is None
+
+    @property
+    def outside_triple(self):
+        return self.outside.triple if self.outside else None
+
+    @property
+    def outside_edge(self):
+        return self.outside.edge if self.outside else None
+
+    @property
+    def outside_is_nonterminal(self):
+        return self.outside.is_nonterminal if self.outside else False
 
-        self.rev_mapping = dict((val, key) for key, val in mapping.items())
-
-        self.nodelabels = nodelabels
-
-        # Store the nonterminal symbol and index of the previous complete
-        # on this item so we can rebuild the derivation easily
-        triples = rule.rhs1.triples(nodelabels=nodelabels)
-        self.outside_symbol = None
-        if size < len(triples):
-            # this item is not closed
-            self.outside_triple = triples[rule.rhs1_visit_order[size]]
-            self.outside_edge = self.outside_triple[1]
-            self.closed = False
-            self.outside_is_nonterminal = isinstance(self.outside_triple[1], NonterminalLabel)
-            if self.outside_is_nonterminal:
-                self.outside_symbol = self.outside_triple[1].label
-                self.outside_nt_index = self.outside_triple[1].index
-        else:
-            # this item is closed
-            self.outside_triple = None
-            self.outside_edge = None
-            self.closed = True
-            self.outside_is_nonterminal = False
-
-        self.__cached_hash = None
+    @property
+    def outside_symbol(self):
+        return self.outside.symbol if self.outside else None
+
+    @property
+    def outside_nt_index(self):
+        return self.outside.nt_index
 
     def __hash__(self):
-        # memoize the hash function
-        if not self.__cached_hash:
-            self.__cached_hash = 2 * hash(self.rule) + 3 * self.size + \
-                                 5 * hash(self.shifted)
         return self.__cached_hash
 
     def __eq__(self, other):
         return isinstance(other, HergItem) and \
-               other.rule == self.rule and \
-               other.size == self.size and \
-               other.shifted == self.shifted and \
-               other.mapping == self.mapping
+               other.__cached_hash == self.__cached_hash and \
+               other.key == self.key
 
     def __lt__(self, other):
-        return self.__str__().__lt__(other.__str__())
+        if self.key[:3] != other.key[:3]:
+            return self.key[:3] < other.key[:3]
+        # unmapped rule nodes are None, which does not compare with node numbers
+        return [-1 if node is None else node for node in self.mapping] < \
+               [-1 if node is None else node for node in other.mapping]
 
     def __repr__(self):
-        return 'HergItem(%d, %d, %s, %s)' % (self.rule.rule_id, self.size, self.rule.symbol, len(self.shifted))
+        return 'HergItem(%d, %d, %s, %s)' % (self.rule.rule_id, self.size, self.rule.symbol,
+                                             len(self.shifted_edges()))
 
     def __str__(self):
         return '[%d, %d/%d, %s, {%s}]' % (self.rule.rule_id,
                                           self.size,
-                                          len(self.rule.rhs1.triples()),
+                                          len(self.rule.rhs1_positions),
                                           self.outside_symbol,
-                                          str([x for x in self.shifted]))
+                                          str(self.shifted_edges()))
 
-    def can_shift(self, new_edge):
+    def shifted_edges(self):
         """
-        Determines whether new_edge matches the outside of this item, and can be
-        shifted.
+        Returns the edges of the input graph consumed by this item.
         """
-        # can't shift into a closed item
-        if self.closed:
-            return False
-        # can't shift an edge that is already inside this item
-        if new_edge in self.shifted:
-            return False
-        olabel = self.outside_triple[1]
-        nlabel = new_edge[1]
-        # make sure new_edge mathes the outside label
-        if olabel != nlabel:
-            return False
-        # make sure new_edge preserves a consistent mapping between the nodes of the
-        # graph and the nodes of the rule
-        if self.nodelabels:
-            o1, o1_label = self.outside_triple[0]
-            n1, n1_label = new_edge[0]
-            if o1_label != n1_label:
-                return False
-        else:
-            o1 = self.outside_triple[0]
-            n1 = new_edge[0]
+        return self.graph_index.decode_edges(self.shifted) if self.shifted else []
 
-        if o1 in self.mapping and self.mapping[o1] != n1:
-            return False
+    def nodes(self):
+        """
+        Returns the nodes of the input graph covered by this item.
+        """
+        return self.graph_index.decode_nodes(self.nodeset) if self.nodeset else []
 
-        # If this node is not a node of this rule RHS, but of a subgraph,
-        # it needs to have a mapping otherwise, we can't attach.
-        if n1 in self.nodeset and n1 not in self.rev_mapping:
-            return False
+    def mapped(self, rule_node):
+        """
+        Returns the graph node the given rule node is mapped to, or None.
+        """
+        node = self.mapping[self.rule.rhs1_node_index[rule_node]]
+        return self.graph_index.nodes[node] if node is not None else None
 
-        if self.nodelabels:
-            if self.outside_triple[2]:
-                o2, o2_labels = zip(*self.outside_triple[2])
-            else:
-                o2, o2_labels = [], []
-            if new_edge[2]:
-                n2, n2_labels = zip(*new_edge[2])
-            else:
-                n2, n2_labels = [], []
-            if o2_labels != n2_labels:
-                return False
-        else:
-            o2 = self.outside_triple[2]
-            n2 = new_edge[2]
+    def waiting_key(self):
+        """
+        Returns the key of the closed items that can complete the outside of this
+        item: their symbol, the attachment nodes already mapped by this item,
+        and the graph nodes they are mapped to.
+        """
+        outside = self.outside
+        mapping = self.mapping
+        return outside.symbol, outside.bound, tuple(mapping[i] for i in outside.bound_nodes)
 
-            if len(o2) != len(n2):
-                return False
+    def completion_key(self, bound):
+        """
+        Returns the waiting_key of the items that wait for this closed item with
+        the given attachment nodes mapped, or None if the number of attachment
+        nodes differs.
+        """
+        attachment = self.rule.rhs1_attachment
+        if len(bound) != len(attachment):
+            return None
+        mapping = self.mapping
+        return self.rule.symbol, bound, tuple(
+            mapping[i] if i is not None else None for i, is_bound in zip(attachment, bound) if is_bound)
+
+    def shift_candidates(self):
+        """
+        Returns the edges of the input graph that have the labels of the outside
+        edge, and its head node if that is already mapped.
+        """
+        outside = self.outside
+        head = self.mapping[outside.attachment[0]]
+        return self.graph_index.shift_lookup.get((outside.shift_pattern, head), ())
 
-        for i in range(len(o2)):
-            if o2[i] in self.mapping and self.mapping[o2[i]] != n2[i]:
-                return False
-            # Again, need to make sure this node is part of the rule RHS, not of a  proper subgraph.
-            if n2[i] in self.nodeset and n2[i] not in self.rev_mapping:
+    def can_shift(self, new_edge):
+        """
+        Determines whether new_edge, one of the shift_candidates of this item, can
+        be shifted. The labels are known to match, so this only checks that the
+        edge is new and preserves a consistent mapping between the nodes of the
+        graph and the nodes of the rule.
+        """
+        # can't shift an edge that is already inside this item
+        if self.graph_index.edge_bits[new_edge] & self.shifted:
+            return False
+
+        mapping = self.mapping
+        for i, node in zip(self.outside.attachment, self.graph_index.edge_nodes[new_edge]):
+            mapped = mapping[i]
+            if mapped is None:
+                # If this node is not a node of this rule RHS, but of a subgraph,
+                # it needs to have a mapping otherwise, we can't attach.
+                if 1 << node & self.nodeset and node not in mapping:
+                    return False
+            elif mapped != node:
                 return False
 
         return True
@@ -160,80 +243,53 @@ class HergItem(Item):
         Creates the chart item resulting from a shift of new_edge. Assumes
         can_shift returned true.
         """
-        o1 = self.outside_triple[0][0] if self.nodelabels else self.outside_triple[0]
-        o2 = tuple(x[0] for x in self.outside_triple[2]) if self.nodelabels else self.outside_triple[2]
+        new_nodeset = self.nodeset
+        new_mapping = list(self.mapping)
+        for i, node in zip(self.outside.attachment, self.graph_index.edge_nodes[new_edge]):
+            new_mapping[i] = node
+            new_nodeset |= 1 << node
 
-        n1 = new_edge[0][0] if self.nodelabels else new_edge[0]
-        n2 = tuple(x[0] for x in new_edge[2]) if self.nodelabels else new_edge[2]
-
-        new_nodeset = self.nodeset | set(n2) | set([n1])
-
-        assert len(o2) == len(n2)
         new_size = self.size + 1
-        new_shifted = frozenset(self.shifted | set([new_edge]))
-        new_mapping = dict(self.mapping)
-        new_mapping[o1] = n1
-        for i in range(len(o2)):
-            new_mapping[o2[i]] = n2[i]
-
-        return HergItem(self.rule, new_size, new_shifted, new_mapping, new_nodeset, self.nodelabels)
+        new_shifted = self.shifted | self.graph_index.edge_bits[new_edge]
+        return HergItem(self.rule, new_size, new_shifted, tuple(new_mapping), new_nodeset, self.graph_index)
 
     def can_complete(self, new_item):
         """
         Determines whether new_item matches the outside of this item (i.e. if the
         nonterminals match and the node mappings agree).
         """
-        # can't add to a closed item
-        if self.closed:
+        outside = self.outside
+        # can't add to a closed item, or complete a terminal
+        if outside is None or not outside.is_nonterminal:
             return False
         # can't shift an incomplete item
         if not new_item.closed:
             return False
 
-        # make sure labels agree
-        if not self.outside_is_nonterminal:
-            return False
-
         # Make sure items are disjoint
-        if any(edge in self.shifted for edge in new_item.shifted):
-            return False
-
-        # make sure mappings agree
-        if self.nodelabels:
-            o1, o1label = self.outside_triple[0]
-            if self.outside_triple[2]:
-                o2, o2labels = zip(*self.outside_triple[2])
-            else:
-                o2, o2labels = [], []
-        else:
-            o1 = self.outside_triple[0]
-            o2 = self.outside_triple[2]
-
-        if len(o2) != len(new_item.rule.rhs1.external_nodes):
+        if self.shifted & new_item.shifted:
             return False
 
-        nroot = list(new_item.rule.rhs1.roots)[0]
-
-        # Check root label
-        if self.nodelabels and o1label != new_item.rule.rhs1.node_to_concepts[nroot]:
+        # make sure the root and external nodes of new_item agree with the outside
+        # edge in number and labels
+        rule = new_item.rule
+        if len(outside.attachment) != len(rule.rhs1_attachment):
             return False
-
-        if o1 in self.mapping and self.mapping[o1] != new_item.mapping[nroot]:
+        if outside.attachment_labels != rule.rhs1_attachment_labels:
             return False
 
-        for i in range(len(o2)):
-            otail = o2[i]
-            ntail = new_item.rule.rhs1.rev_external_nodes[i]
-            # Check tail label
-            if self.nodelabels and o2labels[i] != new_item.rule.rhs1.node_to_concepts[ntail]:
-                return False
-            if otail in self.mapping and self.mapping[otail] != new_item.mapping[ntail]:
+        # make sure mappings agree
+        mapping = self.mapping
+        new_mapping = new_item.mapping
+        for i, j in zip(outside.attachment, rule.rhs1_attachment):
+            mapped = mapping[i]
+            if mapped is not None and mapped != (new_mapping[j] if j is not None else None):
                 return False
 
-        for node in new_item.mapping.values():
-            if node in self.rev_mapping:
-                onode = self.rev_mapping[node]
-                if not (onode == o1 or onode in o2):
+        attached = outside.attached
+        for node in new_mapping:
+            if node is not None and node in mapping:
+                if mapping.index(node) not in attached:
                     return False
 
         return True
@@ -241,20 +297,13 @@ class HergItem(Item):
     def complete(self, new_item):
         """
         Creates the chart item resulting from a complete of new_item. Assumes
-        can_shift returned true.
+        can_complete returned true.
         """
-        o1 = self.outside_triple[0][0] if self.nodelabels else self.outside_triple[0]
-        o2 = tuple(x[0] for x in self.outside_triple[2]) if self.nodelabels else self.outside_triple[2]
-
         new_size = self.size + 1
-        new_shifted = frozenset(self.shifted | new_item.shifted)
-        new_mapping = dict(self.mapping)
-        new_mapping[o1] = new_item.mapping[list(new_item.rule.rhs1.roots)[0]]
-        for i in range(len(o2)):
-            otail = o2[i]
-            ntail = new_item.rule.rhs1.rev_external_nodes[i]
-            new_mapping[otail] = new_item.mapping[ntail]
+        new_shifted = self.shifted | new_item.shifted
+        new_mapping = list(self.mapping)
+        for i, j in zip(self.outside.attachment, new_item.rule.rhs1_attachment):
+            new_mapping[i] = new_item.mapping[j] if j is not None else None
         new_nodeset = self.nodeset | new_item.nodeset
 
-        new = HergItem(self.rule, new_size, new_shifted, new_mapping, new_nodeset, self.nodelabels)
-        return new
+        return HergItem(self.rule, new_size, new_shifted, tuple(new_mapping), new_nodeset, self.graph_index)
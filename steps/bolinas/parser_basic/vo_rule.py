@@ -3,6 +3,37 @@ from tuw_nlp.sem.hrg.steps.bolinas.common.nonterminal import NonterminalLabel
 from tuw_nlp.sem.hrg.steps.bolinas.common.rule import Rule
 
 
+def shift_pattern(triple, nodelabels):
+    """
+    The labels a graph edge must have to be shifted for the given rule edge:
+    the edge label and the head and tail node labels, or the number of tails
+    without node labels.
+    """
+    head, label, tails = triple
+    if nodelabels:
+        return label, head[1], tuple(node[1] for node in tails)
+    return label, len(tails)
+
+
+class VisitPosition(object):
+    """
+    The outside edge of an item of a rule that has visited a given number of edges.
+    attachment holds the indices of the head and tail nodes in rule.rhs1_nodes,
+    attachment_labels their node labels, and bound tells for each of them if
+    it is already mapped at this position.
+    """
+    __slots__ = ("triple", "edge", "is_nonterminal", "symbol", "nt_index", "attachment", "attachment_labels",
+                 "attached", "bound", "bound_nodes", "shift_pattern")
+
+    def __init__(self, triple):
+        self.triple = triple
+        self.edge = triple[1]
+        self.is_nonterminal = isinstance(self.edge, NonterminalLabel)
+        self.symbol = self.edge.label if self.is_nonterminal else None
+        self.nt_index = self.edge.index if self.is_nonterminal else None
+        self.shift_pattern = None
+
+
 class VoRule(Rule):
     """
     A rule that stores a simple visit order for the graph.
@@ -39,6 +70,7 @@ class VoRule(Rule):
             self.is_terminal = not any(rhs1.nonterminal_edges())
             self.rhs1_visit_order = rhs1_visit_order if rhs1_visit_order is not None else range(
                 len(rhs1.triples(nodelabels=nodelabels)))
+            self._compile_visit_positions()
         else:
             self.is_terminal = not any([t for t in rhs1 if type(t) is NonterminalLabel])
             self.rhs1_visit_order = rhs1_visit_order if rhs1_visit_order is not None else range(len(rhs1))
@@ -55,6 +87,53 @@ class VoRule(Rule):
         else:
             self.original_index = None
 
+    def _compile_visit_positions(self):
+        """
+        Precompute the outside edge for every position of the visit order, and
+        number the nodes of the RHS, so that chart items do not have to.
+        """
+        triples = self.rhs1.triples(nodelabels=self.nodelabels)
+        self.rhs1_positions = [VisitPosition(triples[i]) for i in self.rhs1_visit_order]
+
+        nodes = []
+        for head, _, tails in triples:
+            for node in (head,) + tuple(tails):
+                node_id = node[0] if self.nodelabels else node
+                if node_id not in nodes:
+                    nodes.append(node_id)
+        for node_id in self.rhs1.roots:
+            if node_id not in nodes:
+                nodes.append(node_id)
+        self.rhs1_nodes = tuple(nodes)
+        self.rhs1_node_index = dict((node_id, i) for i, node_id in enumerate(nodes))
+
+        # the nodes visited before a position are the ones mapped in its items
+        visited = set()
+        for position in self.rhs1_positions:
+            head, _, tails = position.triple
+            attachment = [head[0] if self.nodelabels else head]
+            attachment.extend(node[0] if self.nodelabels else node for node in tails)
+            position.attachment = tuple(self.rhs1_node_index[node_id] for node_id in attachment)
+            position.attached = frozenset(position.attachment)
+            if self.nodelabels:
+                position.attachment_labels = (head[1],) + tuple(node[1] for node in tails)
+            else:
+                position.attachment_labels = None
+            position.bound = tuple(i in visited for i in position.attachment)
+            position.bound_nodes = tuple(i for i in position.attachment if i in visited)
+            if not position.is_nonterminal:
+                position.shift_pattern = shift_pattern(position.triple, self.nodelabels)
+            visited.update(position.attachment)
+
+        # root and external nodes, in the order they attach to a nonterminal edge
+        root = list(self.rhs1.roots)[0]
+        external = [self.rhs1.rev_external_nodes[i] for i in range(len(self.rhs1.external_nodes))]
+        self.rhs1_attachment = tuple(self.rhs1_node_index.get(node_id) for node_id in [root] + external)
+        if self.nodelabels:
+            self.rhs1_attachment_labels = tuple(self.rhs1.node_to_concepts.get(node_id) for node_id in [root] + external)
+        else:
+            self.rhs1_attachment_labels = None
+
     def __repr__(self):
         return 'VoRule(%d,%s)' % (self.rule_id, self.symbol)
 
@@ -1,13 +1,14 @@
 from tuw_nlp.sem.hrg.steps.bolinas.common.exceptions import NotAllNodesCoveredException
 from tuw_nlp.sem.hrg.steps.bolinas.common.hgraph.hgraph import Hgraph
 from tuw_nlp.sem.hrg.steps.bolinas.common.oie import extract_for_kth_derivation
+from tuw_nlp.sem.hrg.steps.bolinas.common.symbols import symbols
 
 
 def check_membership(parser, bolinas_graph):
     used_rules = None
     log_lines = ["\nVALIDATION:\n"]
     input_graph = Hgraph.from_string(bolinas_graph)
-    orig_nodes = sorted(list(input_graph.get_nodes().keys()), key=lambda node: int(node[1:]))
+    orig_nodes = sorted(list(input_graph.get_nodes().keys()), key=symbols.node_number)
     parse_generator = parser.parse_graphs([input_graph], partial=False)
 
     for i, (chart, parse_logs) in enumerate(parse_generator):
@@ -26,7 +27,7 @@ def check_membership(parser, bolinas_graph):
             )
             log_lines.append(f"\n{derivation_log}")
 
-            not_covered_nodes = sorted(set(orig_nodes) - set(derived_nodes), key=lambda node: int(node[1:]))
+            not_covered_nodes = sorted(set(orig_nodes) - set(derived_nodes), key=symbols.node_number)
             if len(not_covered_nodes) != 0:
                 raise NotAllNodesCoveredException(orig_nodes, derived_nodes, not_covered_nodes)
 